@@ -1,29 +1,168 @@
 from fastapi import FastAPI, HTTPException, Header
 from runner import run_ai_for_trial
-from db import fetch_active_trials
+from db import fetch_active_trials, fetch_ai_run
+from loader import load_trials_visits
+from persistence.pipeline import WriteBehindQueue
+from jobs import submit_run, get_run
+from config import CRON_FETCH_BATCH_SIZE, CRON_TRIAL_WORKERS, DB_POOL_MAX_SIZE
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import os 
+import time
+import uuid
 
 app = FastAPI()
 
 CRON_SECRET = os.getenv("CRON_SECRET")
 
+
+def _cron_workers():
+    # Leave one pooled connection for the writer thread and batch loads
+    return max(1, min(CRON_TRIAL_WORKERS, DB_POOL_MAX_SIZE - 1))
+
+
+def _run_cron_trial(trial_id, df, writer):
+    """
+    One trial of the daily cron; a failure is reported, never raised,
+    so it cannot stop the other trials.
+    """
+    started = time.perf_counter()
+    try:
+        ai_run_id = run_ai_for_trial(
+            trial_id,
+            triggered_by="cron",
+            df=df,
+            writer=writer
+        )
+        status, error = ("computed" if ai_run_id else "skipped"), None
+    except Exception as e:
+        print(f"Trial {trial_id} failed:", str(e))
+        # Set by the runner once the failed run's ai_runs row exists
+        ai_run_id = getattr(e, "ai_run_id", None)
+        status, error = "failed", str(e)
+
+    return {
+        "trial_id": str(trial_id),
+        "ai_run_id": str(ai_run_id) if ai_run_id else None,
+        "status": status,
+        "seconds": round(time.perf_counter() - started, 3),
+        "error": error
+    }
+
+
+def _failed_trial(trial_id, error):
+    return {
+        "trial_id": str(trial_id),
+        "ai_run_id": None,
+        "status": "failed",
+        "seconds": 0.0,
+        "error": str(error)
+    }
+
+
 @app.post("/cron/run-daily-ai")
 def run_daily_ai(x_cron_secret: str = Header(None)):
     if x_cron_secret != CRON_SECRET:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
+    started = time.perf_counter()
     trial_ids = fetch_active_trials()
+    workers = _cron_workers()
+    futures = []
+
+    # Up to `workers` trials compute at once; finished runs are written
+    # by the writer thread while the next ones compute
+    with WriteBehindQueue() as writer, ThreadPoolExecutor(max_workers=workers) as pool:
+
+        # Load trials a batch at a time: one query per batch instead of per trial
+        for start in range(0, len(trial_ids), CRON_FETCH_BATCH_SIZE):
+
+            # Only load the next batch once a worker is free for it, so
+            # at most one batch of frames waits in memory
+            running = [f for f in futures if not f.done()]
+            while len(running) >= workers:
+                wait(running, return_when=FIRST_COMPLETED)
+                running = [f for f in running if not f.done()]
+
+            batch = trial_ids[start:start + CRON_FETCH_BATCH_SIZE]
+            try:
+                frames = load_trials_visits(batch)
+            except Exception as e:
+                print("Could not load trial batch:", str(e))
+                futures.extend(
+                    pool.submit(_failed_trial, trial_id, e) for trial_id in batch
+                )
+                continue
 
-    for trial_id in trial_ids:
-        run_ai_for_trial(trial_id, triggered_by="cron")
+            for trial_id in batch:
+                futures.append(
+                    pool.submit(_run_cron_trial, trial_id, frames.pop(trial_id), writer)
+                )
 
-    return {"status": "ok", "trials_processed": len(trial_ids)}
+    trials = [f.result() for f in futures]
 
+    # Runs the writer could not persist
+    write_errors = {str(ai_run_id): str(e) for ai_run_id, e in writer.failures}
+    for trial in trials:
+        if trial["status"] != "computed":
+            continue
+        if trial["ai_run_id"] in write_errors:
+            trial["status"] = "failed"
+            trial["error"] = write_errors[trial["ai_run_id"]]
+        else:
+            trial["status"] = "completed"
 
-@app.post("/run-ai/{trial_id}")
+    failed = [t for t in trials if t["status"] == "failed"]
+
+    return {
+        "status": "ok" if not failed else "partial",
+        "trials_processed": len(trial_ids),
+        "workers": workers,
+        "seconds": round(time.perf_counter() - started, 3),
+        "failed_runs": sorted(write_errors),
+        "trials": trials
+    }
+
+
+@app.post("/run-ai/{trial_id}", status_code=202)
 def run_ai(trial_id: str):
+    # Returns at once; the run computes in the background (see jobs.py)
     try:
-        run_ai_for_trial(trial_id)
-        return {"status": "completed", "trial_id": trial_id}
+        job, coalesced = submit_run(trial_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "status": job["status"],
+        "trial_id": job["trial_id"],
+        "ai_run_id": job["ai_run_id"],
+        "coalesced": coalesced
+    }
+
+
+@app.get("/runs/{ai_run_id}")
+def get_run_status(ai_run_id: str):
+    # Run ids are UUIDs; anything else would fail the uuid cast in the query
+    try:
+        uuid.UUID(ai_run_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="AI run not found")
+
+    job = get_run(ai_run_id)
+    if job is not None:
+        return job
+
+    # Runs not submitted to this process (cron, CLI, before a restart)
+    try:
+        run = fetch_ai_run(ai_run_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if run is None:
+        raise HTTPException(status_code=404, detail="AI run not found")
+
+    trial_id, status, completed_at = run
+    return {
+        "ai_run_id": ai_run_id,
+        "trial_id": trial_id,
+        "status": status,
+        "finished_at": completed_at.isoformat() if completed_at else None
+    }
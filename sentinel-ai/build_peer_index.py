@@ -0,0 +1,44 @@
+import sys
+
+import numpy as np
+
+from db import fetch_active_trials
+from runner import cross_hospital_vectors
+from detectors.cross_hospital import PeerIndex
+
+
+# ---------------------------
+# Reference peer index
+# ---------------------------
+#
+# Builds the PeerIndex that CROSS_HOSPITAL_MODE=peers scores against
+# when PEER_INDEX_PATH points at it:
+#
+#     python build_peer_index.py <output_path> [trial_id ...]
+#
+# Trials default to every active trial. A hospital in several trials
+# gets one reference vector, the mean of its vectors. Build with the
+# same PEER_SIZE_FEATURES setting the runs use.
+
+def build_peer_index(trial_ids):
+    vectors_by_hospital = {}
+    for trial_id in trial_ids:
+        for hospital_id, vector in cross_hospital_vectors(trial_id).items():
+            vectors_by_hospital.setdefault(hospital_id, []).append(vector)
+
+    if len(vectors_by_hospital) < 2:
+        raise ValueError("A peer index needs at least 2 hospitals")
+
+    return PeerIndex({
+        hospital_id: np.mean(vectors, axis=0)
+        for hospital_id, vectors in vectors_by_hospital.items()
+    })
+
+
+if __name__ == "__main__":
+    output_path = sys.argv[1]
+    trial_ids = sys.argv[2:] or fetch_active_trials()
+
+    index = build_peer_index(trial_ids)
+    index.save(output_path)
+    print(f"Peer index of {len(index.hospital_ids)} hospitals saved to {output_path}")
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import pandas as pd
+
+from config import (
+    CHECKPOINT_DIR,
+    AI_VERSION,
+    DETECTOR_MODE,
+    CROSS_HOSPITAL_MODE,
+    PEER_GROUP_K,
+    PEER_SIZE_FEATURES,
+    PEER_SIZE_WEIGHT,
+    PEER_INDEX_PATH
+)
+
+
+# ---------------------------
+# Stage checkpoints for AI runs
+# ---------------------------
+#
+# CHECKPOINT_DIR/<ai_run_id>/
+#     meta.json       data + settings fingerprint the stages were computed on
+#     <stage>.pkl     output of one completed stage
+#
+# A failed run keeps its checkpoints, so a retry on the same data
+# resumes after the last completed stage. The trial frame itself is not
+# checkpointed: the retry reloads it from the loader.py snapshot. They are removed once the
+# run's results are persisted.
+
+def _run_dir(ai_run_id):
+    return os.path.join(CHECKPOINT_DIR, str(ai_run_id))
+
+
+def settings_digest():
+    """
+    Hash of the settings that change stage outputs, so a retry after
+    changing one of them recomputes instead of resuming stale stages.
+    """
+    # A reference index is identified by its file, not just its path
+    index_mtime = (
+        os.path.getmtime(PEER_INDEX_PATH)
+        if PEER_INDEX_PATH and os.path.exists(PEER_INDEX_PATH) else None
+    )
+    settings = (
+        DETECTOR_MODE,
+        CROSS_HOSPITAL_MODE,
+        PEER_GROUP_K,
+        PEER_SIZE_FEATURES,
+        PEER_SIZE_WEIGHT,
+        PEER_INDEX_PATH,
+        index_mtime
+    )
+    return hashlib.sha1(repr(settings).encode()).hexdigest()[:12]
+
+
+def frame_fingerprint(df):
+    """
+    Identifies the data and settings a run was computed with. Locked
+    visits are immutable, so row count + latest created_at pins the
+    frame (the same pair loader.py pins its snapshot with).
+    """
+    latest = pd.Timestamp(int(df["created_at"].max())).isoformat() if len(df) else None
+    return f"{_fingerprint_prefix(len(df))}{latest}"
+
+
+def _fingerprint_prefix(rows):
+    return f"{AI_VERSION}:{settings_digest()}:{rows}:"
+
+
+def checkpoints_cover(ai_run_id, rows):
+    """
+    Whether the run's stages were computed with the current settings on
+    a frame of `rows` rows. Locked visits only grow, so a trial that has
+    exactly that many locked values now still has the same frame.
+    """
+    fingerprint = read_fingerprint(ai_run_id)
+    return fingerprint is not None and fingerprint.startswith(_fingerprint_prefix(rows))
+
+
+def read_fingerprint(ai_run_id):
+    path = os.path.join(_run_dir(ai_run_id), "meta.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["fingerprint"]
+
+
+def start_checkpoints(ai_run_id, fingerprint):
+    """
+    Binds the run's checkpoint directory to a fingerprint, dropping
+    stages computed on different data.
+    """
+    if read_fingerprint(ai_run_id) == fingerprint:
+        return
+
+    clear_checkpoints(ai_run_id)
+    os.makedirs(_run_dir(ai_run_id), exist_ok=True)
+    with open(os.path.join(_run_dir(ai_run_id), "meta.json"), "w") as f:
+        json.dump({"fingerprint": fingerprint}, f)
+
+
+def has_stage(ai_run_id, stage):
+    return os.path.exists(os.path.join(_run_dir(ai_run_id), f"{stage}.pkl"))
+
+
+def load_stage(ai_run_id, stage):
+    with open(os.path.join(_run_dir(ai_run_id), f"{stage}.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+def save_stage(ai_run_id, stage, value):
+    # Write-then-rename so a crash mid-write never leaves a bad stage
+    path = os.path.join(_run_dir(ai_run_id), f"{stage}.pkl")
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def run_stage(ai_run_id, stage, compute, *args):
+    """
+    Returns the checkpointed output of stage, or computes and
+    checkpoints it.
+    """
+    if has_stage(ai_run_id, stage):
+        print(f"Resuming from checkpoint: {stage}")
+        return load_stage(ai_run_id, stage)
+
+    value = compute(*args)
+    save_stage(ai_run_id, stage, value)
+    return value
+
+
+def clear_checkpoints(ai_run_id):
+    shutil.rmtree(_run_dir(ai_run_id), ignore_errors=True)
@@ -12,3 +12,104 @@ WEIGHTS = {
     "cross_patient": 0.25,
     "peer_deviation": 0.20
 }
+
+# How db.fetch_locked_visits reads the trial: "copy" (COPY ... TO STDOUT,
+# fastest) or "cursor" (server-side cursor, streamed in chunks)
+FETCH_METHOD = os.getenv("FETCH_METHOD", "copy")
+
+# Rows pulled per round-trip from the server-side cursor in db.iter_locked_visits
+FETCH_CHUNK_SIZE = int(os.getenv("FETCH_CHUNK_SIZE", "50000"))
+
+# Local columnar snapshots of trial visits (see loader.py)
+TRIAL_STATE_DIR = os.getenv("TRIAL_STATE_DIR", ".trial_state")
+
+# Delta loads re-read this much before the watermark to catch visits
+# that were committed after the previous fetch but stamped before it
+DELTA_LOOKBACK_MINUTES = int(os.getenv("DELTA_LOOKBACK_MINUTES", "10"))
+
+# Shared psycopg2 pool used by db.py and persistence/writer.py
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+
+# Pooled connections idle for longer than this are pinged before reuse
+DB_POOL_HEALTHCHECK_SECONDS = int(os.getenv("DB_POOL_HEALTHCHECK_SECONDS", "30"))
+
+# Bytes of COPY output buffered before each decode into the column arrays
+COPY_DECODE_BYTES = int(os.getenv("COPY_DECODE_BYTES", str(4 * 1024 * 1024)))
+
+# Active trials loaded per batched query by the daily cron
+CRON_FETCH_BATCH_SIZE = int(os.getenv("CRON_FETCH_BATCH_SIZE", "10"))
+
+# Trials the daily cron runs at once; capped below DB_POOL_MAX_SIZE so
+# the writer thread and batch loads always have a connection
+CRON_TRIAL_WORKERS = int(os.getenv("CRON_TRIAL_WORKERS", "4"))
+
+# Computed runs allowed to wait for the background writer before the
+# cron loop blocks (see persistence/pipeline.py)
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "2"))
+
+# Per-stage outputs of in-flight AI runs, used to resume failed runs
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", ".checkpoints")
+
+# Items per level of the streaming quantile sketch (features/accumulators.py);
+# quantiles are exact for groups smaller than this
+QUANTILE_SKETCH_K = int(os.getenv("QUANTILE_SKETCH_K", "256"))
+
+# Pair matcher used by detectors/cross_patient.py: "grid" (tolerance-grid
+# hash, scales with patients), "blocked" (dense NumPy row blocks) or
+# "rows" (brute force)
+CROSS_PATIENT_ENGINE = os.getenv("CROSS_PATIENT_ENGINE", "grid")
+
+# Peak temporary memory of one row block of the "blocked" matcher; small
+# blocks stay cache-resident and run fastest
+CROSS_PATIENT_BLOCK_MB = float(os.getenv("CROSS_PATIENT_BLOCK_MB", "2"))
+
+# Candidate pairs the "grid" matcher expands and checks at a time
+CROSS_PATIENT_GRID_CHUNK = int(os.getenv("CROSS_PATIENT_GRID_CHUNK", "1000000"))
+
+# Processes used for hospital-local extraction and detection (parallel.py);
+# 1 runs everything in the calling process
+HOSPITAL_WORKERS = int(os.getenv("HOSPITAL_WORKERS", "1"))
+
+# Task 1 / Task 2 scoring: "matrix" (hospital x feature arrays, one
+# broadcast for every hospital) or "dict" (per-hospital loops)
+DETECTOR_MODE = os.getenv("DETECTOR_MODE", "matrix")
+
+# Task 4 scoring: "centroid" (distance to the trial's centroid) or
+# "peers" (distance to the k nearest peer hospitals, see
+# detectors/cross_hospital.py)
+CROSS_HOSPITAL_MODE = os.getenv("CROSS_HOSPITAL_MODE", "centroid")
+PEER_GROUP_K = int(os.getenv("PEER_GROUP_K", "5"))
+
+# Add hospital size (visit count) to the Task 4 vectors, and its weight
+PEER_SIZE_FEATURES = os.getenv("PEER_SIZE_FEATURES", "0") == "1"
+PEER_SIZE_WEIGHT = float(os.getenv("PEER_SIZE_WEIGHT", "0.25"))
+
+# Saved PeerIndex (reference population) to score peers against, built
+# by build_peer_index.py; unset builds the index from the trial's own
+# hospitals
+PEER_INDEX_PATH = os.getenv("PEER_INDEX_PATH")
+
+# Detectors run by runner.run_ai_for_trial (comma-separated); stages
+# they depend on are computed even when not listed
+DETECTORS = ("statistical", "behavioral", "cross_patient", "cross_hospital")
+
+ENABLED_DETECTORS = [
+    name.strip()
+    for name in os.getenv("ENABLED_DETECTORS", ",".join(DETECTORS)).split(",")
+    if name.strip()
+]
+
+_unknown_detectors = sorted(set(ENABLED_DETECTORS) - set(DETECTORS))
+if _unknown_detectors:
+    raise ValueError(
+        f"Unknown ENABLED_DETECTORS {_unknown_detectors}; expected any of {list(DETECTORS)}"
+    )
+
+# Threads running independent stages of one AI run concurrently
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", "3"))
+
+# Background threads running AI runs submitted through POST /run-ai (jobs.py),
+# and how many finished jobs are kept for GET /runs/{id}
+RUN_AI_WORKERS = int(os.getenv("RUN_AI_WORKERS", "2"))
+RUN_AI_JOB_HISTORY = int(os.getenv("RUN_AI_JOB_HISTORY", "200"))
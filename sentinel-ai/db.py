@@ -1,23 +1,45 @@
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import pandas as pd
-from config import DB_URL
-
-def get_connection():
-    return psycopg2.connect(DB_URL)
+from config import (
+    DB_URL,
+    FETCH_METHOD,
+    FETCH_CHUNK_SIZE,
+    COPY_DECODE_BYTES,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_HEALTHCHECK_SECONDS
+)
+from schema import ID_COLUMNS, TIMESTAMP_COLUMNS, compact_frame, concat_frames
 
-def fetch_active_trials():
-    query = """
-        SELECT id
-        FROM trials
-        WHERE status = 'active'
+LOCKED_VISITS_FROM = """
+    FROM visits v
+    JOIN visit_values vv ON v.id = vv.visit_id
+    WHERE v.trial_id = %s
+      AND v.status = 'locked'
+      AND vv.value_number IS NOT NULL
     """
-    df = pd.read_sql(query, get_connection())
-    return df["id"].tolist()
 
+# Several trials at once; since is NULL for trials fetched in full
+MULTI_TRIAL_VISITS_FROM = """
+    FROM visits v
+    JOIN visit_values vv ON v.id = vv.visit_id
+    JOIN unnest(%s::uuid[], %s::timestamptz[]) AS w(trial_id, since)
+      ON v.trial_id = w.trial_id
+    WHERE v.status = 'locked'
+      AND vv.value_number IS NOT NULL
+      AND (w.since IS NULL OR v.created_at > w.since)
+    """
 
-def fetch_locked_visits(trial_id):
-    query = """
-    SELECT
+VISIT_FIELDS = """
         v.id AS visit_id,
         v.hospital_id,
         v.patient_id,
@@ -25,10 +47,484 @@ def fetch_locked_visits(trial_id):
         v.created_at,
         vv.crf_field_id,
         vv.value_number
-    FROM visits v
-    JOIN visit_values vv ON v.id = vv.visit_id
-    WHERE v.trial_id = %s
-      AND v.status = 'locked'
-      AND vv.value_number IS NOT NULL
     """
-    return pd.read_sql(query, get_connection(), params=[trial_id])
+
+# COPY variant: timestamps as epoch seconds so they decode as plain floats
+COPY_VISIT_FIELDS = """
+        v.id,
+        v.hospital_id,
+        v.patient_id,
+        extract(epoch FROM v.visit_date),
+        extract(epoch FROM v.created_at),
+        vv.crf_field_id,
+        vv.value_number
+    """
+
+# Appended to LOCKED_VISITS_FROM for delta loads
+CREATED_AFTER_FILTER = """
+      AND v.created_at > %s
+    """
+
+VISIT_COLUMNS = [
+    "visit_id",
+    "hospital_id",
+    "patient_id",
+    "visit_date",
+    "created_at",
+    "crf_field_id",
+    "value_number"
+]
+
+
+# ---------------------------
+# Connection pool
+# ---------------------------
+#
+# One pool per process, shared by the loader and persistence.writer.
+# ThreadedConnectionPool raises when exhausted, so checkouts are gated
+# by a semaphore of the same size and simply wait for a free slot.
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_last_used = {}
+
+
+def _get_pool():
+    global _pool, _pool_pid, _pool_slots
+
+    with _pool_lock:
+        # A forked worker must not reuse the parent's sockets
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_URL
+            )
+            _pool_pid = os.getpid()
+            _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+            _last_used.clear()
+
+    return _pool, _pool_slots
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+
+    # Only ping connections that sat idle long enough to have been
+    # dropped by the pooler; never-used ones were just opened
+    last_used = _last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_POOL_HEALTHCHECK_SECONDS:
+        return True
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _return_connection(pool, conn, broken):
+    """
+    Puts a checked-out connection back, rolled back, or closes it if
+    it is broken (including one whose rollback fails).
+    """
+    if not broken and not conn.closed:
+        try:
+            status = conn.get_transaction_status()
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            broken = True
+
+    discard = broken or bool(conn.closed)
+    if discard:
+        _last_used.pop(id(conn), None)
+    else:
+        _last_used[id(conn)] = time.monotonic()
+    pool.putconn(conn, close=discard)
+
+
+@contextmanager
+def get_connection():
+    """
+    Checks a pooled connection out for the duration of the block.
+
+    Uncommitted work is rolled back on return; callers that write
+    must commit themselves.
+    """
+    pool, slots = _get_pool()
+    slots.acquire()
+
+    conn = None
+    broken = False
+    try:
+        conn = pool.getconn()
+        while not _is_healthy(conn):
+            _last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            # Already returned: never put back again if getconn fails
+            conn = None
+            conn = pool.getconn()
+
+        yield conn
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+
+    finally:
+        # The slot is released even if returning the connection fails
+        try:
+            if conn is not None:
+                _return_connection(pool, conn, broken)
+        finally:
+            slots.release()
+
+
+def fetch_active_trials():
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id
+                FROM trials
+                WHERE status = 'active'
+                """
+            )
+            return [str(row[0]) for row in cur.fetchall()]
+
+
+def fetch_latest_finished_run(trial_id):
+    """
+    Returns (ai_run_id, status) of the trial's most recently finished
+    (completed or failed) ai_run, or None.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, status
+                FROM ai_runs
+                WHERE trial_id = %s
+                  AND completed_at IS NOT NULL
+                ORDER BY completed_at DESC
+                LIMIT 1
+                """,
+                (trial_id,)
+            )
+            row = cur.fetchone()
+
+    return (str(row[0]), row[1]) if row else None
+
+
+def fetch_ai_run(ai_run_id):
+    """
+    Returns (trial_id, status, completed_at) of an ai_run, or None.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT trial_id, status, completed_at
+                FROM ai_runs
+                WHERE id = %s
+                """,
+                (ai_run_id,)
+            )
+            row = cur.fetchone()
+
+    return (str(row[0]), row[1], row[2]) if row else None
+
+
+def count_locked_values(trial_id, until):
+    """
+    Number of locked visit values created at or before `until`.
+    Used as the data fingerprint of a local trial snapshot.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT count(*)" + LOCKED_VISITS_FROM
+                + "AND v.created_at <= %s",
+                (trial_id, until)
+            )
+            return int(cur.fetchone()[0])
+
+
+def count_locked_values_for_trials(until_by_trial):
+    """
+    Batched count_locked_values: {trial_id: until} -> {trial_id: count}
+    """
+    if not until_by_trial:
+        return {}
+
+    trial_ids = list(until_by_trial)
+
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT v.trial_id, count(*)
+                FROM visits v
+                JOIN visit_values vv ON v.id = vv.visit_id
+                JOIN unnest(%s::uuid[], %s::timestamptz[]) AS w(trial_id, until)
+                  ON v.trial_id = w.trial_id
+                WHERE v.status = 'locked'
+                  AND vv.value_number IS NOT NULL
+                  AND v.created_at <= w.until
+                GROUP BY v.trial_id
+                """,
+                (trial_ids, [until_by_trial[t] for t in trial_ids])
+            )
+            counts = {str(t): int(n) for t, n in cur.fetchall()}
+
+    return {t: counts.get(str(t), 0) for t in trial_ids}
+
+
+def _typed_chunk(rows, columns=VISIT_COLUMNS):
+    """
+    Turns raw cursor tuples into a compact frame (see schema.py):
+    float64 values (psycopg2 returns NUMERIC as Decimal), categorical
+    ids and int64 epoch-ns UTC timestamps.
+    """
+    chunk = pd.DataFrame.from_records(rows, columns=columns)
+
+    for col in TIMESTAMP_COLUMNS:
+        chunk[col] = (
+            pd.to_datetime(chunk[col], utc=True)
+            .dt.tz_localize(None)
+        )
+
+    return compact_frame(chunk)
+
+
+def _iter_chunks(query, params, columns, chunk_size):
+    with get_connection() as conn:
+        with conn.cursor(name="locked_visits") as cur:
+            cur.itersize = chunk_size
+            cur.execute(query, params)
+
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield _typed_chunk(rows, columns)
+
+
+def iter_locked_visits(trial_id, since=None, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Streams locked visit values through a named (server-side) cursor.
+
+    Yields typed DataFrames of at most chunk_size rows, so the full
+    result set is never held client-side as psycopg2 tuples.
+    If since is given, only visits created after it are returned.
+    """
+    query = "SELECT" + VISIT_FIELDS + LOCKED_VISITS_FROM
+    params = [trial_id]
+
+    if since is not None:
+        query += CREATED_AFTER_FILTER
+        params.append(since)
+
+    return _iter_chunks(query, params, VISIT_COLUMNS, chunk_size)
+
+
+# ---------------------------
+# COPY bulk loader
+# ---------------------------
+
+class _CopyColumnSink:
+    """
+    File-like target for COPY ... TO STDOUT (CSV).
+
+    psycopg2 calls write() once per row; rows are buffered and decoded
+    in blocks of COPY_DECODE_BYTES by the pandas C parser straight into
+    column arrays that grow geometrically, so no row count is needed up
+    front. Id columns are dictionary-encoded block by block, so only
+    int32 codes and the distinct ids are kept.
+    """
+
+    def __init__(self, columns=VISIT_COLUMNS):
+        self.names = list(columns)
+        self.columns = {}
+        self.categories = {}
+        for col in self.names:
+            if col in TIMESTAMP_COLUMNS:
+                dtype = "int64"
+            elif col == "value_number":
+                dtype = "float64"
+            else:
+                dtype = "int32"
+                self.categories[col] = {}
+            self.columns[col] = np.empty(0, dtype=dtype)
+
+        self.capacity = 0
+        self.filled = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= COPY_DECODE_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        block = pd.read_csv(
+            io.BytesIO(b"".join(self._buffer)),
+            header=None,
+            names=self.names,
+            dtype={
+                col: str if col in self.categories else "float64"
+                for col in self.names
+            }
+        )
+        self._buffer = []
+        self._buffered = 0
+
+        start, end = self.filled, self.filled + len(block)
+        if end > self.capacity:
+            self._resize(max(end, 2 * self.capacity))
+
+        for col in self.names:
+            values = block[col].to_numpy()
+
+            if col in self.categories:
+                # Block-local codes -> sink-wide codes
+                lookup = self.categories[col]
+                codes, uniques = pd.factorize(values)
+                remap = np.array(
+                    [lookup.setdefault(u, len(lookup)) for u in uniques],
+                    dtype="int32"
+                )
+                values = remap[codes]
+
+            elif col in TIMESTAMP_COLUMNS:
+                # epoch seconds -> ns, keeping microsecond precision
+                values = np.round(values * 1e6).astype("int64") * 1000
+
+            self.columns[col][start:end] = values
+
+        self.filled = end
+
+    def _resize(self, capacity):
+        # In place (realloc); the sink holds the only reference
+        for values in self.columns.values():
+            values.resize(capacity, refcheck=False)
+        self.capacity = capacity
+
+    def frame(self):
+        # Trim the spare capacity before handing the arrays out
+        self._resize(self.filled)
+
+        columns = {}
+        for col in self.names:
+            values = self.columns[col]
+            if col in self.categories:
+                values = pd.Categorical.from_codes(
+                    values, categories=list(self.categories[col])
+                )
+            columns[col] = values
+
+        return pd.DataFrame(columns, columns=self.names)
+
+
+def _copy_frame(select, from_clause, params, columns):
+    """
+    COPY (select + from_clause) TO STDOUT into a _CopyColumnSink.
+    """
+    sink = _CopyColumnSink(columns)
+
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            query = cur.mogrify(select + from_clause, params)
+            cur.copy_expert(
+                b"COPY (" + query + b") TO STDOUT WITH (FORMAT csv)",
+                sink
+            )
+            sink.flush()
+
+    return sink.frame()
+
+
+def copy_locked_visits(trial_id, since=None):
+    """
+    Bulk-loads locked visit values with COPY (SELECT ...) TO STDOUT.
+    """
+    from_clause = LOCKED_VISITS_FROM
+    params = [trial_id]
+
+    if since is not None:
+        from_clause += CREATED_AFTER_FILTER
+        params.append(since)
+
+    return _copy_frame(
+        "SELECT" + COPY_VISIT_FIELDS, from_clause, params, VISIT_COLUMNS
+    )
+
+
+def fetch_locked_visits(trial_id, since=None, chunk_size=FETCH_CHUNK_SIZE):
+    if FETCH_METHOD == "copy":
+        return copy_locked_visits(trial_id, since=since)
+
+    chunks = list(
+        iter_locked_visits(trial_id, since=since, chunk_size=chunk_size)
+    )
+
+    if not chunks:
+        return _typed_chunk([])
+
+    return concat_frames(chunks)
+
+
+def fetch_locked_visits_for_trials(since_by_trial, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Fetches several trials in one query and partitions the result.
+
+    Input: {trial_id: since or None}
+    Output: {trial_id: DataFrame} (empty frame for trials with no rows)
+    """
+    trial_ids = list(since_by_trial)
+    if not trial_ids:
+        return {}
+
+    params = [trial_ids, [since_by_trial[t] for t in trial_ids]]
+    columns = ["trial_id"] + VISIT_COLUMNS
+
+    if FETCH_METHOD == "copy":
+        df = _copy_frame(
+            "SELECT v.trial_id," + COPY_VISIT_FIELDS,
+            MULTI_TRIAL_VISITS_FROM,
+            params,
+            columns
+        )
+    else:
+        chunks = list(_iter_chunks(
+            "SELECT v.trial_id," + VISIT_FIELDS + MULTI_TRIAL_VISITS_FROM,
+            params,
+            columns,
+            chunk_size
+        ))
+        df = concat_frames(chunks) if chunks else _typed_chunk([], columns)
+
+    frames = {}
+    for trial_id, tdf in df.groupby("trial_id", sort=False, observed=True):
+        tdf = tdf.drop(columns="trial_id").reset_index(drop=True)
+        # Partitions share the batch-wide id dictionaries; trim them
+        for col in ID_COLUMNS:
+            if col in tdf.columns:
+                tdf[col] = tdf[col].cat.remove_unused_categories()
+        frames[str(trial_id)] = tdf
+
+    empty = _typed_chunk([])
+
+    return {
+        t: frames[str(t)] if str(t) in frames else empty.copy()
+        for t in trial_ids
+    }
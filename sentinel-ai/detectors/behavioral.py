@@ -384,3 +384,161 @@ def detect_behavioral_anomalies(features, baseline=None, trial_phase="PHASE_3"):
         }
 
     return results
+
+
+# ---------------------------
+# Matrix mode
+# ---------------------------
+#
+# Same rules and scores as detect_behavioral_anomalies, for every
+# hospital at once from a (hospital x feature) matrix.
+
+BASELINE_KEYS = (
+    "median_delay_days",
+    "p90_delay_days",
+    "submission_burstiness",
+    "same_hour_ratio",
+    "weekend_ratio",
+    "same_day_visit_ratio",
+)
+MATRIX_KEYS = ("short_gap_ratio", "hard_gap_violations") + BASELINE_KEYS
+
+# Heuristic checks, in signal order: (score columns, ratio that must also
+# exceed 0.4 or None, reason)
+HEURISTIC_CHECKS = (
+    (("median_delay_days", "p90_delay_days"), None,
+     "Unusually high delay between visit date and data entry"),
+    (("submission_burstiness",), None,
+     "Batch-style submission behavior detected"),
+    (("same_hour_ratio",), "same_hour_ratio",
+     "Large fraction of visits entered in the same hour"),
+    (("weekend_ratio",), "weekend_ratio",
+     "Unusually high proportion of weekend data entry"),
+    (("same_day_visit_ratio",), "same_day_visit_ratio",
+     "Large proportion of visits occurred on the same clinical day"),
+)
+
+
+def stack_behavioral_features(features):
+    """
+    hospital -> features  =>  {"hospital_ids", "values" (hospital x MATRIX_KEYS)}
+    """
+    return {
+        "hospital_ids": list(features.keys()),
+        "values": np.array(
+            [[h.get(k, 0.0) for k in MATRIX_KEYS] for h in features.values()],
+            dtype=float
+        ).reshape(len(features), len(MATRIX_KEYS))
+    }
+
+
+def build_behavioral_baseline_matrix(matrix):
+    """
+    build_behavioral_baseline for stacked features:
+    {"mu", "sigma"} arrays aligned with BASELINE_KEYS.
+    """
+    # One contiguous row per feature, reduced like the 1-d np.mean/np.std
+    columns = [MATRIX_KEYS.index(k) for k in BASELINE_KEYS]
+    values = np.ascontiguousarray(matrix["values"][:, columns].T)
+    return {
+        "mu": np.mean(values, axis=1),
+        "sigma": np.std(values, axis=1) + 1e-6
+    }
+
+
+def detect_behavioral_anomalies_matrix(matrix, baseline=None, trial_phase="PHASE_3"):
+    """
+    detect_behavioral_anomalies for stacked features.
+    """
+    rules = VISIT_GAP_RULES.get(trial_phase, VISIT_GAP_RULES["PHASE_3"])
+    MIN_GAP = rules["min_gap_days"]
+
+    values = matrix["values"]
+    n_hospitals = len(values)
+    column = {k: j for j, k in enumerate(MATRIX_KEYS)}
+
+    # ABSOLUTE rules as masks
+    short_gap_ratio = values[:, column["short_gap_ratio"]]
+    critical = values[:, column["hard_gap_violations"]] > 0
+    critical_list = critical.tolist()
+    major = ~critical & (short_gap_ratio > 0)
+
+    # (same rounding as the per-hospital path)
+    scores = np.zeros((n_hospitals, 1 + len(HEURISTIC_CHECKS)))
+    present = np.zeros(scores.shape, dtype=bool)
+    scores[major, 0] = [min(1.0, round(r * 1.5, 2)) for r in short_gap_ratio[major]]
+    present[major, 0] = True
+
+    # HEURISTIC checks: all z-scores in one broadcast
+    flagged = np.zeros(scores.shape, dtype=bool)
+    if baseline:
+        z = np.abs(
+            values[:, [column[k] for k in BASELINE_KEYS]] - baseline["mu"]
+        ) / baseline["sigma"]
+        z_of = {k: z[:, j] for j, k in enumerate(BASELINE_KEYS)}
+
+        for c, (keys, ratio_key, _) in enumerate(HEURISTIC_CHECKS, start=1):
+            zs = z_of[keys[0]]
+            for k in keys[1:]:
+                zs = np.maximum(zs, z_of[k])
+            scores[:, c] = np.minimum(zs / 3.0, 1.0)
+            flagged[:, c] = scores[:, c] > 0.6
+            if ratio_key is not None:
+                flagged[:, c] &= values[:, column[ratio_key]] > 0.4
+        present[:, 1:] = True
+
+    present[critical] = False
+    flagged &= present
+    counts = present.sum(axis=1)
+    totals = np.where(present, scores, 0.0).sum(axis=1)
+
+    # Plain Python values for the per-hospital result dicts
+    behavioral_scores = [
+        round(total / count, 2) if count else 0.0
+        for total, count in zip(totals.tolist(), counts.tolist())
+    ]
+    flagged_hospitals = set(np.flatnonzero(flagged.any(axis=1) | major).tolist())
+    flagged_rows = flagged.tolist()
+    score_rows = scores.tolist()
+
+    results = {}
+    for i, hospital_id in enumerate(matrix["hospital_ids"]):
+        if critical_list[i]:
+            results[hospital_id] = {
+                "behavioral_score": 1.0,
+                "signals": [{
+                    "severity": "CRITICAL",
+                    "score": 1.0,
+                    "reason": (
+                        "One or more patient visits occurred less than 24 hours apart, "
+                        f"which is clinically implausible in {trial_phase.replace('_', ' ')} trials."
+                    )
+                }]
+            }
+            continue
+
+        signals = []
+        if i in flagged_hospitals:
+            if major[i]:
+                signals.append({
+                    "severity": "MAJOR",
+                    "score": score_rows[i][0],
+                    "reason": (
+                        f"{int(short_gap_ratio[i] * 100)}% of patient visit intervals are "
+                        f"shorter than {MIN_GAP} days, indicating abnormal visit scheduling."
+                    )
+                })
+            for c, (_, _, reason) in enumerate(HEURISTIC_CHECKS, start=1):
+                if flagged_rows[i][c]:
+                    signals.append({
+                        "severity": "MINOR",
+                        "score": round(score_rows[i][c], 2),
+                        "reason": reason
+                    })
+
+        results[hospital_id] = {
+            "behavioral_score": behavioral_scores[i],
+            "signals": signals
+        }
+
+    return results
@@ -1,4 +1,9 @@
+import pickle
+
 import numpy as np
+from sklearn.neighbors import BallTree
+
+from config import PEER_GROUP_K
 
 
 def detect_cross_hospital_deviation(hospital_vectors):
@@ -64,3 +69,119 @@ def detect_cross_hospital_deviation(hospital_vectors):
         }
 
     return results
+
+
+# ---------------------------
+# Peer-group mode
+# ---------------------------
+#
+# Instead of one global centroid, each hospital is compared with its k
+# nearest peers (BallTree, O(n log n)). The index can be built over a
+# reference population (e.g. hospitals of other trials), saved, and
+# reused across runs.
+
+class PeerIndex:
+    """
+    BallTree over reference hospital vectors, with the reference
+    hospitals' own mean distance to their k nearest peers.
+    """
+
+    def __init__(self, hospital_vectors, k=PEER_GROUP_K):
+        self.hospital_ids = list(hospital_vectors.keys())
+        vectors = np.array(list(hospital_vectors.values()), dtype=float)
+
+        self.k = max(min(k, len(self.hospital_ids) - 1), 1)
+        self.tree = BallTree(vectors)
+
+        # Leave-one-out peer distances of the reference hospitals
+        reference = self.peer_distances(hospital_vectors)
+        self.mean_dist = float(np.mean(reference))
+        self.std_dist = float(np.std(reference)) + 1e-6
+
+    def peer_distances(self, hospital_vectors):
+        """
+        Mean distance of each hospital to its k nearest reference peers,
+        skipping the hospital itself if it is in the index.
+        """
+        hospital_ids = list(hospital_vectors.keys())
+        vectors = np.array(list(hospital_vectors.values()), dtype=float)
+
+        width = np.asarray(self.tree.data).shape[1]
+        if vectors.ndim != 2 or vectors.shape[1] != width:
+            raise ValueError(
+                f"Hospital vectors have {vectors.shape[-1]} features but the "
+                f"peer index was built with {width}; rebuild it with the "
+                f"current settings (e.g. PEER_SIZE_FEATURES)"
+            )
+
+        # One extra neighbour, in case the nearest is the hospital itself
+        k = min(self.k + 1, len(self.hospital_ids))
+        distances, indices = self.tree.query(vectors, k=k)
+
+        reference_ids = np.array(self.hospital_ids, dtype=object)
+        query_ids = np.array(hospital_ids, dtype=object)
+        peer = reference_ids[indices] != query_ids[:, None]
+        peer &= np.cumsum(peer, axis=1) <= self.k
+
+        return np.where(peer, distances, 0.0).sum(axis=1) / peer.sum(axis=1)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def detect_peer_group_deviation(hospital_vectors, k=PEER_GROUP_K, index=None):
+    """
+    Same input / output as detect_cross_hospital_deviation, scored
+    against each hospital's k nearest peers.
+
+    index is a PeerIndex over a reference population; by default one
+    is built over hospital_vectors. Only hospitals farther from their
+    peers than the reference hospitals are from theirs are flagged.
+    """
+    results = {}
+
+    # A trial with no scored hospitals has nothing to compare
+    if not hospital_vectors:
+        return results
+
+    if index is None and len(hospital_vectors) < 2:
+        # Cannot compare peers with <2 hospitals
+        for h in hospital_vectors:
+            results[h] = {
+                "peer_deviation_score": 0.0,
+                "signals": []
+            }
+        return results
+
+    if index is None:
+        index = PeerIndex(hospital_vectors, k)
+
+    distances = index.peer_distances(hospital_vectors)
+
+    for hospital_id, dist in zip(hospital_vectors, distances.tolist()):
+        z = max(dist - index.mean_dist, 0.0) / index.std_dist
+        score = min(z / 3.0, 1.0)
+
+        signals = []
+        if score > 0.6:
+            signals.append({
+                "score": round(score, 2),
+                "reason": (
+                    "Hospital shows significant overall deviation "
+                    "from its nearest peer hospitals across multiple "
+                    "integrity dimensions"
+                )
+            })
+
+        results[hospital_id] = {
+            "peer_deviation_score": round(float(score), 2),
+            "signals": signals
+        }
+
+    return results
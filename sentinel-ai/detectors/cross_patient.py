@@ -211,59 +211,365 @@
 
 #     return results
 
-from itertools import combinations
+from itertools import product
 
+import numpy as np
+
+from config import (
+    CROSS_PATIENT_ENGINE,
+    CROSS_PATIENT_BLOCK_MB,
+    CROSS_PATIENT_GRID_CHUNK
+)
+
+# Grid cells are this much wider than the tolerance, so float rounding
+# in value / cell can never put two matching values two cells apart
+GRID_CELL_MARGIN = 1e-6
+
+# The grid engine hands off to the blocked engine once its candidate
+# pairs exceed this share of all (patient pair, field) cells, or this
+# many in total (matched pairs are held until the end)
+GRID_MAX_CANDIDATE_SHARE = 0.02
+GRID_MAX_CANDIDATES = 4_000_000
+
+
+# ---------------------------
+# Pair matching engines
+# ---------------------------
+#
+# Each engine takes the dense (patients x fields) first / last / slope
+# arrays of one hospital and returns the number of patient pairs that
+# match on at least min_matching_fields fields. Missing (NaN) cells
+# never match. All engines give identical results.
+
+def _rows_templated_pairs(first, last, slope, value_tol, slope_tol, min_matching_fields):
+    """
+    Brute force: each patient against every later patient at once.
+    """
+    templated_pairs = 0
+
+    for i in range(len(first) - 1):
+        matching = (
+            (np.abs(first[i + 1:] - first[i]) <= value_tol) &
+            (np.abs(last[i + 1:] - last[i]) <= value_tol) &
+            (np.abs(slope[i + 1:] - slope[i]) <= slope_tol)
+        )
+        templated_pairs += int(
+            np.count_nonzero(matching.sum(axis=1) >= min_matching_fields)
+        )
+
+    return templated_pairs
+
+
+def _expand_ranges(lo, hi):
+    """
+    (owner, index) for every index in every [lo[i], hi[i]) range.
+    """
+    counts = hi - lo
+    owner = np.repeat(np.arange(len(lo)), counts)
+    index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, lo[owner] + index
+
+
+def _grid_candidate_chunks(lo, hi, chunk):
+    """
+    Splits owners 0..len(lo) into runs [start, stop) of about `chunk`
+    candidates each (a single owner may exceed it).
+    """
+    ends = np.cumsum(hi - lo)
+    start = 0
+    while start < len(lo):
+        limit = ends[start] - (hi[start] - lo[start]) + chunk
+        stop = max(int(np.searchsorted(ends, limit, side="right")), start + 1)
+        yield start, stop
+        start = stop
+
+
+def _grid_pair_matches(first, last, slope, value_tol, slope_tol,
+                       chunk=CROSS_PATIENT_GRID_CHUNK):
+    """
+    (patient_a, patient_b, matching_fields) for every pair with at
+    least one matching field, patient_a < patient_b; None if the grid
+    does not fit an int64 cell key, or if the cells are so crowded that
+    the dense engines do less work.
+
+    Each field's (first, last, slope) is quantized into tolerance-sized
+    cells; values within tolerance are at most one cell apart, so only
+    patients in the same or a neighbouring cell of a field are
+    candidates. Candidates are checked exactly, `chunk` at a time.
+    """
+    n_patients, n_fields = first.shape
+
+    present = np.isfinite(first) & np.isfinite(last) & np.isfinite(slope)
+    patients, fields = np.nonzero(present)
+    if len(patients) == 0:
+        return patients, patients, patients
+
+    value_cell = value_tol * (1 + GRID_CELL_MARGIN)
+    slope_cell = slope_tol * (1 + GRID_CELL_MARGIN)
+    x = np.floor(first[patients, fields] / value_cell)
+    y = np.floor(last[patients, fields] / value_cell)
+    z = np.floor(slope[patients, fields] / slope_cell)
+
+    # Pack (field, x, y, z) into one integer; the +1 / +3 padding keeps
+    # neighbour offsets from wrapping into another row of the grid
+    spans = [int(c.max() - c.min()) + 3 for c in (x, y, z)]
+    if n_fields * spans[0] * spans[1] * spans[2] >= 2 ** 62:
+        return None
+
+    key = fields.astype(np.int64)
+    for c, span in zip((x, y, z), spans):
+        key = key * span + (c - c.min() + 1).astype(np.int64)
+
+    order = np.argsort(key, kind="stable")
+    sorted_keys = key[order]
+    sorted_patients = patients[order]
+    sorted_fields = fields[order]
+
+    # Candidate ranges of every offset, sized before anything is expanded
+    ranges = []
+    candidates = 0
+    for dx, dy, dz in product((-1, 0, 1), repeat=3):
+        # Offsets d and -d find the same pairs; walk one half of them
+        if (dx, dy, dz) < (0, 0, 0):
+            continue
+
+        target = sorted_keys + (dx * spans[1] + dy) * spans[2] + dz
+        lo = np.searchsorted(sorted_keys, target, side="left")
+        hi = np.searchsorted(sorted_keys, target, side="right")
+        ranges.append(((dx, dy, dz) == (0, 0, 0), lo, hi))
+        candidates += int((hi - lo).sum())
+
+    # Heavily rounded values put most patients in the same cells and
+    # candidates grow as patients^2 x fields; past this share of the
+    # blocked engine's cell count, blocked is faster and memory-bounded
+    dense_cells = n_patients * (n_patients - 1) // 2 * n_fields
+    if candidates > min(dense_cells * GRID_MAX_CANDIDATE_SHARE, GRID_MAX_CANDIDATES):
+        return None
+
+    code_parts, count_parts = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    pending = 0
+    for same_cell, lo, hi in ranges:
+        for start, stop in _grid_candidate_chunks(lo, hi, chunk):
+            owner, other = _expand_ranges(lo[start:stop], hi[start:stop])
+            owner += start
+
+            pa, pb = sorted_patients[owner], sorted_patients[other]
+            if same_cell:
+                keep = pa < pb
+                pa, pb, owner = pa[keep], pb[keep], owner[keep]
+
+            a = np.minimum(pa, pb)
+            b = np.maximum(pa, pb)
+            f = sorted_fields[owner]
+
+            matching = (
+                (np.abs(first[a, f] - first[b, f]) <= value_tol) &
+                (np.abs(last[a, f] - last[b, f]) <= value_tol) &
+                (np.abs(slope[a, f] - slope[b, f]) <= slope_tol)
+            )
+
+            codes, counts = np.unique(
+                a[matching].astype(np.int64) * n_patients + b[matching],
+                return_counts=True
+            )
+            code_parts.append(codes)
+            count_parts.append(counts)
+            pending += len(codes)
+
+            # Fold the parts together now and then, so a pair matching
+            # on many fields is held once rather than once per chunk
+            if pending > chunk:
+                code_parts, count_parts = _merge_pair_counts(code_parts, count_parts)
+                pending = 0
+
+    (pair_codes,), (counts,) = _merge_pair_counts(code_parts, count_parts)
+    return pair_codes // n_patients, pair_codes % n_patients, counts
+
+
+def _merge_pair_counts(code_parts, count_parts):
+    """
+    Sums the counts of equal pair codes across parts; one part out.
+    """
+    codes, inverse = np.unique(np.concatenate(code_parts), return_inverse=True)
+    counts = np.bincount(
+        inverse, weights=np.concatenate(count_parts), minlength=len(codes)
+    ).astype(np.int64)
+    return [codes], [counts]
+
+
+def _grid_templated_pairs(first, last, slope, value_tol, slope_tol, min_matching_fields):
+    """
+    Tolerance-grid hash: near-linear in patients unless most of them
+    share cells.
+    """
+    # Zero-size cells, or pairs that qualify without any matching field,
+    # go to the brute-force engine
+    if value_tol <= 0 or slope_tol <= 0 or min_matching_fields <= 0:
+        return _rows_templated_pairs(
+            first, last, slope, value_tol, slope_tol, min_matching_fields
+        )
+
+    # A grid too wide to pack or too crowded to pay off goes to blocked
+    matches = _grid_pair_matches(first, last, slope, value_tol, slope_tol)
+    if matches is None:
+        return _blocked_templated_pairs(
+            first, last, slope, value_tol, slope_tol, min_matching_fields
+        )
+
+    _, _, counts = matches
+    return int(np.count_nonzero(counts >= min_matching_fields))
+
+
+def _block_rows(n_patients, n_fields, block_mb):
+    """
+    Patients per row block so one block's temporaries fit in block_mb.
+    """
+    # float64 |diff| buffer plus two boolean match buffers
+    bytes_per_cell = 8 + 1 + 1
+    per_row = max(n_patients * n_fields * bytes_per_cell, 1)
+    return max(int(block_mb * 1024 * 1024 // per_row), 1)
+
+
+def _iter_blocked_counts(first, last, slope, value_tol, slope_tol, block_mb):
+    """
+    Yields (rows, cols, counts) per row block: matching field counts
+    of patient rows[i] against patient cols[j], for cols[j] > rows[i].
+    """
+    n_patients, n_fields = first.shape
+
+    # (component, patient, field): one contiguous patients x fields
+    # matrix per signature component
+    signatures = np.ascontiguousarray(np.stack([first, last, slope]))
+    tols = (value_tol, value_tol, slope_tol)
+    step = _block_rows(n_patients, n_fields, block_mb)
+
+    for start in range(0, n_patients - 1, step):
+        stop = min(start + step, n_patients)
+        shape = (stop - start, n_patients - start, n_fields)
+
+        # Block rows against themselves and every later patient
+        diff = np.empty(shape)
+        matching = np.ones(shape, dtype=bool)
+        within = np.empty(shape, dtype=bool)
+        for component, tol in zip(signatures, tols):
+            np.subtract(component[start:stop, None], component[None, start:], out=diff)
+            np.abs(diff, out=diff)
+            np.less_equal(diff, tol, out=within)
+            matching &= within
+
+        counts = np.count_nonzero(matching, axis=2)
+        rows, cols = np.nonzero(
+            np.arange(start, n_patients)[None, :] > np.arange(start, stop)[:, None]
+        )
+        yield rows + start, cols + start, counts[rows, cols]
+
+
+def _blocked_pair_matches(first, last, slope, value_tol, slope_tol,
+                          block_mb=CROSS_PATIENT_BLOCK_MB):
+    """
+    (patient_a, patient_b, matching_fields) for every pair with at
+    least one matching field, patient_a < patient_b.
+    """
+    a_parts, b_parts, count_parts = [], [], []
+    for rows, cols, counts in _iter_blocked_counts(
+        first, last, slope, value_tol, slope_tol, block_mb
+    ):
+        matched = counts > 0
+        a_parts.append(rows[matched])
+        b_parts.append(cols[matched])
+        count_parts.append(counts[matched])
+
+    if not a_parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    return np.concatenate(a_parts), np.concatenate(b_parts), np.concatenate(count_parts)
+
+
+def _blocked_templated_pairs(first, last, slope, value_tol, slope_tol, min_matching_fields):
+    """
+    Dense broadcasting over memory-bounded row blocks
+    (CROSS_PATIENT_BLOCK_MB per block).
+    """
+    templated_pairs = 0
+    for _, _, counts in _iter_blocked_counts(
+        first, last, slope, value_tol, slope_tol, CROSS_PATIENT_BLOCK_MB
+    ):
+        templated_pairs += int(np.count_nonzero(counts >= min_matching_fields))
+    return templated_pairs
+
+
+ENGINES = {
+    "rows": _rows_templated_pairs,
+    "grid": _grid_templated_pairs,
+    "blocked": _blocked_templated_pairs
+}
+
+
+def pair_match_counts(signatures, value_tol=0.1, slope_tol=0.1, engine=CROSS_PATIENT_ENGINE):
+    """
+    Matching field counts of every patient pair of one hospital that
+    matches on at least one field.
+
+    signatures is one hospital's entry of extract_cross_patient_features.
+    Returns (patient_ids_a, patient_ids_b, matching_fields) arrays.
+    """
+    first, last, slope = signatures["first"], signatures["last"], signatures["slope"]
+
+    matches = None
+    if engine == "grid" and value_tol > 0 and slope_tol > 0:
+        matches = _grid_pair_matches(first, last, slope, value_tol, slope_tol)
+    if matches is None:
+        matches = _blocked_pair_matches(first, last, slope, value_tol, slope_tol)
+
+    a, b, counts = matches
+    patient_ids = signatures["patient_ids"]
+    return patient_ids[a], patient_ids[b], counts
+
+
+# ---------------------------
+# Detector
+# ---------------------------
 
 def detect_cross_patient_templating(
     hospital_patient_data,
     value_tol=0.1,
     slope_tol=0.1,
     min_matching_fields=4,
-    min_pairs=2
+    min_pairs=2,
+    engine=CROSS_PATIENT_ENGINE
 ):
     """
     Detects true cross-patient templating.
 
     A patient pair is considered templated only if
     MANY fields share nearly identical longitudinal patterns.
+
+    hospital_patient_data is the dense signature format of
+    features.cross_patient.extract_cross_patient_features; engine is a
+    key of ENGINES.
     """
 
+    count_templated_pairs = ENGINES[engine]
     results = {}
 
-    for hospital_id, patients in hospital_patient_data.items():
-        patient_ids = list(patients.keys())
+    for hospital_id, signatures in hospital_patient_data.items():
 
         # Too few patients → no accusation
-        if len(patient_ids) < 3:
+        if len(signatures["patient_ids"]) < 3:
             results[hospital_id] = {
                 "cross_patient_score": 0.0,
                 "signals": []
             }
             continue
 
-        templated_pairs = 0
-
-        for p1, p2 in combinations(patient_ids, 2):
-            sig1 = patients[p1]
-            sig2 = patients[p2]
-
-            common_fields = set(sig1.keys()) & set(sig2.keys())
-            matching_fields = 0
-
-            for field in common_fields:
-                f1 = sig1[field]
-                f2 = sig2[field]
-
-                if (
-                    abs(f1["first"] - f2["first"]) <= value_tol and
-                    abs(f1["last"] - f2["last"]) <= value_tol and
-                    abs(f1["slope"] - f2["slope"]) <= slope_tol
-                ):
-                    matching_fields += 1
-
-            # Only count as templated if MANY fields match
-            if matching_fields >= min_matching_fields:
-                templated_pairs += 1
+        templated_pairs = count_templated_pairs(
+            signatures["first"],
+            signatures["last"],
+            signatures["slope"],
+            value_tol,
+            slope_tol,
+            min_matching_fields
+        )
 
         score = min(templated_pairs / min_pairs, 1.0)
 
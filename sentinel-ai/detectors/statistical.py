@@ -93,3 +93,124 @@ def detect_statistical_anomalies(features, baseline):
         }
 
     return results
+
+
+# ---------------------------
+# Matrix mode
+# ---------------------------
+#
+# Same baseline and scores as above, with the features held as
+# (hospital x field) arrays plus a presence mask, so every z-score and
+# field score comes out of one broadcast.
+
+MATRIX_FEATURES = ("mean", "std", "entropy", "rounding_ratio")
+
+
+def stack_statistical_features(features):
+    """
+    hospital -> field -> features  =>  {
+        "hospital_ids", "field_ids", "mask",
+        "mean", "std", "entropy", "rounding_ratio"    (hospital x field)
+    }
+    """
+    hospital_ids = list(features.keys())
+    field_ids = list(dict.fromkeys(
+        field_id
+        for hospital_data in features.values()
+        for field_id in hospital_data
+    ))
+    columns = {field_id: j for j, field_id in enumerate(field_ids)}
+
+    shape = (len(hospital_ids), len(field_ids))
+    matrix = {
+        "hospital_ids": hospital_ids,
+        "field_ids": field_ids,
+        "mask": np.zeros(shape, dtype=bool)
+    }
+    for name in MATRIX_FEATURES:
+        matrix[name] = np.zeros(shape)
+
+    for i, hospital_data in enumerate(features.values()):
+        for field_id, stats in hospital_data.items():
+            j = columns[field_id]
+            matrix["mask"][i, j] = True
+            for name in MATRIX_FEATURES:
+                matrix[name][i, j] = stats[name]
+
+    return matrix
+
+
+def _masked_mean_std(values, mask):
+    counts = mask.sum(axis=0)
+    mu = np.where(mask, values, 0.0).sum(axis=0) / counts
+    sigma = np.sqrt(np.where(mask, (values - mu) ** 2, 0.0).sum(axis=0) / counts)
+    return mu, sigma
+
+
+def build_trial_baseline_matrix(matrix):
+    """
+    build_trial_baseline for stacked features: per-field arrays
+    (aligned with matrix["field_ids"]) from masked column reductions.
+    """
+    baseline = {}
+    for name in ("mean", "std", "entropy"):
+        mu, sigma = _masked_mean_std(matrix[name], matrix["mask"])
+        baseline[f"{name}_mu"] = mu
+        baseline[f"{name}_sigma"] = sigma + 1e-6
+    return baseline
+
+
+def detect_statistical_anomalies_matrix(matrix, baseline, features):
+    """
+    detect_statistical_anomalies for stacked features. features (the
+    dict matrix was stacked from) gives the signal order per hospital.
+    """
+    mask = matrix["mask"]
+
+    mean_z = z_score(matrix["mean"], baseline["mean_mu"], baseline["mean_sigma"])
+    std_z = z_score(matrix["std"], baseline["std_mu"], baseline["std_sigma"])
+    entropy_z = z_score(matrix["entropy"], baseline["entropy_mu"], baseline["entropy_sigma"])
+
+    field_scores = np.minimum(np.maximum(np.maximum(mean_z, std_z), entropy_z) / 3.0, 1.0)
+    field_scores = np.where(mask, field_scores, 0.0)
+
+    counts = mask.sum(axis=1)
+    hospital_scores = np.divide(
+        field_scores.sum(axis=1), counts,
+        out=np.zeros(len(counts)), where=counts > 0
+    )
+
+    flagged = mask & (field_scores > 0.6)
+    columns = {field_id: j for j, field_id in enumerate(matrix["field_ids"])}
+
+    results = {}
+    for i, hospital_id in enumerate(matrix["hospital_ids"]):
+        signals = []
+
+        # Signals only for hospitals with a cell above the threshold
+        if flagged[i].any():
+            for field_id in features[hospital_id]:
+                j = columns[field_id]
+                if not flagged[i, j]:
+                    continue
+
+                reason = []
+                if std_z[i, j] > 2:
+                    reason.append("Unusually low variance")
+                if entropy_z[i, j] > 2:
+                    reason.append("Low randomness")
+                if matrix["rounding_ratio"][i, j] > 0.4:
+                    reason.append("Heavy rounding bias")
+
+                signals.append({
+                    "field_id": field_id,
+                    "score": round(float(field_scores[i, j]), 2),
+                    "reason": ", ".join(reason)
+                })
+
+        results[hospital_id] = {
+            "statistical_score": round(float(hospital_scores[i]), 2),
+            "signals": signals
+        }
+
+    return results
@@ -0,0 +1,204 @@
+import numpy as np
+
+from config import QUANTILE_SKETCH_K
+from schema import concat_frames
+
+
+# ---------------------------
+# Streaming accumulators
+# ---------------------------
+#
+# Per-group state that is updated chunk by chunk, so features can be
+# extracted from db.iter_locked_visits without holding the trial in
+# memory. Each accumulator takes a whole chunk's values for its group
+# at once, and merge() combines the states of two shards of a group.
+
+class Moments:
+    """
+    Count / mean / variance, updated with Welford's (Chan's batch) rule.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def update(self, values):
+        if len(values) == 0:
+            return
+        mean = values.mean()
+        self._combine(len(values), mean, float(((values - mean) ** 2).sum()))
+
+    def merge(self, other):
+        if other.count:
+            self._combine(other.count, other.mean, other.m2)
+        return self
+
+    @property
+    def std(self):
+        # Population std, as np.std
+        return float(np.sqrt(self.m2 / self.count)) if self.count else 0.0
+
+
+class QuantileSketch:
+    """
+    Compactor quantile sketch (KLL-style, deterministic).
+
+    Level h holds items of weight 2**h. A level that reaches k items is
+    sorted and every other item is promoted to level h + 1, so memory
+    stays O(k log(n / k)) per update() stream; a merged sketch holds its
+    inputs' items until its next update(). Until the first compaction the sketch holds
+    every value and quantile() is exact (np.percentile, linear).
+    """
+
+    def __init__(self, k=QUANTILE_SKETCH_K):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        # Alternates which half survives a compaction, per level
+        self._offsets = [0]
+
+    def update(self, values):
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """
+        Adds other's items level by level, without compacting: the
+        result holds exactly the union of both sketches, so merging is
+        associative and commutative and shards combine in any grouping
+        with the same result. Compaction resumes on the next update().
+        """
+        if other.count == 0:
+            return self
+
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+            self._offsets.append(0)
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+            # XOR is order-free too, so later compactions agree as well
+            self._offsets[h] ^= other._offsets[h]
+
+        return self
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) >= self.k:
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self._offsets.append(0)
+
+                level = np.sort(level)
+                # An odd item out stays behind at this level
+                keep = len(level) % 2
+                offset = self._offsets[h]
+                self._offsets[h] ^= 1
+
+                self.levels[h + 1] = np.concatenate([
+                    self.levels[h + 1], level[keep + offset::2]
+                ])
+                self.levels[h] = level[:keep]
+            h += 1
+
+    def weighted_items(self):
+        """
+        (values, weights) sorted by value.
+        """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(level), 2 ** h, dtype=np.int64)
+            for h, level in enumerate(self.levels)
+        ])
+        order = np.argsort(values, kind="stable")
+        return values[order], weights[order]
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+
+        values, weights = self.weighted_items()
+        ends = np.cumsum(weights)
+        total = ends[-1]
+
+        # Same virtual index and lerp as numpy's "linear" method, over
+        # items repeated by their weight
+        virtual = (total - 1) * q
+        previous = int(np.floor(virtual))
+        gamma = virtual - previous
+        following = min(previous + 1, total - 1)
+
+        a = values[np.searchsorted(ends, previous, side="right")]
+        b = values[np.searchsorted(ends, following, side="right")]
+        diff = b - a
+        return float(b - diff * (1 - gamma) if gamma >= 0.5 else a + diff * gamma)
+
+    def entropy(self, bins):
+        """
+        Entropy of a `bins`-bin histogram over [min, max], as
+        scipy.stats.entropy(np.histogram(values, bins)[0]). Exact until
+        the first compaction, then approximated from the weighted items.
+        """
+        if self.count == 0:
+            return 0.0
+
+        values, weights = self.weighted_items()
+        hist, _ = np.histogram(
+            values, bins=bins, range=(self.min, self.max), weights=weights
+        )
+        p = hist[hist > 0] / hist.sum()
+        return float(-(p * np.log(p)).sum())
+
+
+class VisitTable:
+    """
+    First row of every visit seen in a stream of chunks (the rows
+    df.drop_duplicates(subset=["visit_id"]) keeps), for features that
+    need each visit once. Holds one row per visit, not per value.
+    """
+
+    def __init__(self):
+        # Sorted ids of the visits kept so far
+        self.ids = np.empty(0, dtype=object)
+        self.frames = []
+
+    def update(self, chunk):
+        """
+        Adds chunk's unseen visits and returns their rows (None if none).
+        """
+        visits = chunk.drop_duplicates(subset=["visit_id"])
+        ids = visits["visit_id"].astype(str).to_numpy(dtype=object)
+
+        new = ~np.isin(ids, self.ids, assume_unique=True)
+        if not new.any():
+            return None
+
+        self.ids = np.union1d(self.ids, ids[new])
+        visits = visits[new]
+        self.frames.append(visits)
+        return visits
+
+    def frame(self):
+        if not self.frames:
+            return None
+        return concat_frames(self.frames)
@@ -106,103 +106,194 @@
 #     return features
 
 import numpy as np
-import pandas as pd
 
-MIN_VISIT_GAP_DAYS = 7.0
-
-
-def extract_behavioral_features(df):
-    """
-    Absolute, hospital-local behavioral features
-    """
-
-    features = {}
-
-    for hospital_id, hdf in df.groupby("hospital_id"):
-
-        # Collapse to visit-level
-        hdf_visits = (
-            hdf
-            .drop_duplicates(subset=["visit_id"])
-            .copy()
-        )
-
-        if len(hdf_visits) < 2:
-            continue
-
-        visit_dates = pd.to_datetime(hdf_visits["visit_date"])
-        created_times = pd.to_datetime(hdf_visits["created_at"])
-
-        hdf_visits["visit_date"] = visit_dates
-
-        # --------------------------------
-        # ABSOLUTE: Inter-visit gap per patient
-        # --------------------------------
-        gap_violations = 0
-        hard_violations = 0
-        total_pairs = 0
-        min_gap_days = None
+from features.segments import segment_starts, segment_quantile
+from features.trial_frame import as_trial_frame
+from features.accumulators import QuantileSketch, VisitTable
+from schema import NS_PER_HOUR, NS_PER_DAY
 
-        for _, pdf in hdf_visits.groupby("patient_id"):
-            if len(pdf) < 2:
-                continue
+MIN_VISIT_GAP_DAYS = 7.0
 
-            pdf = pdf.sort_values("visit_date")
-            gaps = pdf["visit_date"].diff().dt.total_seconds() / (24 * 3600)
-            gaps = gaps.dropna()
 
-            if gaps.empty:
-                continue
+def _days(ns):
+    # Same float path as Timedelta.total_seconds() / (24 * 3600)
+    return ns / 1e9 / (24 * 3600)
 
-            total_pairs += len(gaps)
 
-            min_gap = gaps.min()
-            min_gap_days = min(min_gap_days, min_gap) if min_gap_days is not None else min_gap
+def _hours(ns):
+    return ns / 1e9 / 3600
 
-            hard_violations += (gaps < 1).sum()
-            gap_violations += (gaps < MIN_VISIT_GAP_DAYS).sum()
 
-        short_gap_ratio = (
-            gap_violations / total_pairs if total_pairs > 0 else 0.0
-        )
+def _max_run_per_group(group_codes_sorted, keys_sorted, n_groups):
+    """
+    Size of the largest run of equal keys within each group, for arrays
+    sorted by (group, key).
+    """
+    starts = segment_starts(group_codes_sorted, keys_sorted)
+    runs = np.diff(np.append(starts, len(keys_sorted)))
+    out = np.zeros(n_groups, dtype=np.int64)
+    np.maximum.at(out, group_codes_sorted[starts], runs)
+    return out
 
-        # --------------------------------
-        # Submission behavior (safe guards)
-        # --------------------------------
-        delays = (created_times - visit_dates).dt.total_seconds() / (24 * 3600)
-        delays = delays[delays >= 0]
 
-        median_delay = float(np.median(delays)) if len(delays) else 0.0
-        p90_delay = float(np.percentile(delays, 90)) if len(delays) else 0.0
+def extract_behavioral_features(trial):
+    """
+    Absolute, hospital-local behavioral features
 
-        created_sorted = created_times.sort_values()
-        inter_arrival_hours = created_sorted.diff().dt.total_seconds() / 3600
-        inter_arrival_hours = inter_arrival_hours.dropna()
+    trial is a TrialFrame (or a trial DataFrame). All hospitals are
+    computed together from its visit-level rows: the (hospital, patient,
+    visit_date) sort gives the inter-visit gaps, then grouped bincount /
+    segment reductions per hospital.
+    """
 
-        burstiness = float(np.std(inter_arrival_hours)) if len(inter_arrival_hours) else 0.0
+    features = {}
 
-        same_hour_ratio = float(
-            created_times.dt.hour.value_counts(normalize=True).iloc[0]
-        )
+    trial = as_trial_frame(trial)
+    hospitals = trial.hospitals
+    n_hospitals = len(hospitals)
+
+    # Visit-level rows (a visit belongs to a single hospital)
+    visits = trial.visits
+    hospital_codes = trial.hospital_codes[visits]
+    visit_ns = trial.visit_ns[visits]
+    created_ns = trial.created_ns[visits]
+
+    visit_counts = np.bincount(hospital_codes, minlength=n_hospitals)
+
+    # --------------------------------
+    # ABSOLUTE: Inter-visit gap per patient
+    # --------------------------------
+    order, patient_starts, _ = trial.visits_by_hospital_patient
+    h = trial.hospital_codes[order]
+    v = trial.visit_ns[order]
+
+    # Gap to the previous visit, only where the patient does not change
+    same_patient = np.ones(len(order), dtype=bool)
+    same_patient[patient_starts] = False
+    same_patient = same_patient[1:]
+    gaps = _days(np.diff(v))[same_patient]
+    gap_hospitals = h[1:][same_patient]
+
+    total_pairs = np.bincount(gap_hospitals, minlength=n_hospitals)
+    hard_violations = np.bincount(
+        gap_hospitals, weights=gaps < 1, minlength=n_hospitals
+    )
+    gap_violations = np.bincount(
+        gap_hospitals, weights=gaps < MIN_VISIT_GAP_DAYS, minlength=n_hospitals
+    )
+    min_gap_days = np.full(n_hospitals, np.inf)
+    np.minimum.at(min_gap_days, gap_hospitals, gaps)
+
+    # --------------------------------
+    # Submission behavior (safe guards)
+    # --------------------------------
+    delays = _days(created_ns - visit_ns)
+    valid = delays >= 0
+    delay_hospitals = hospital_codes[valid]
+    delays = delays[valid]
+
+    order = np.lexsort((delays, delay_hospitals))
+    delays = delays[order]
+    delay_counts = np.bincount(delay_hospitals, minlength=n_hospitals)
+    delay_starts = np.cumsum(delay_counts) - delay_counts
+    median_delay = segment_quantile(delays, delay_starts, delay_counts, 0.5)
+    p90_delay = segment_quantile(delays, delay_starts, delay_counts, 0.9)
+
+    # Inter-arrival std per hospital (population std, as np.std)
+    order = np.lexsort((created_ns, hospital_codes))
+    h = hospital_codes[order]
+    c = created_ns[order]
+    same_hospital = h[1:] == h[:-1]
+    arrivals = _hours(np.diff(c))[same_hospital]
+    arrival_hospitals = h[1:][same_hospital]
+    arrival_counts = np.bincount(arrival_hospitals, minlength=n_hospitals)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        arrival_means = np.bincount(
+            arrival_hospitals, weights=arrivals, minlength=n_hospitals
+        ) / arrival_counts
+        burstiness = np.sqrt(np.bincount(
+            arrival_hospitals,
+            weights=(arrivals - arrival_means[arrival_hospitals]) ** 2,
+            minlength=n_hospitals
+        ) / arrival_counts)
+
+    hours = (created_ns // NS_PER_HOUR) % 24
+    hour_counts = np.bincount(
+        hospital_codes * 24 + hours, minlength=n_hospitals * 24
+    ).reshape(n_hospitals, 24)
+
+    # 1970-01-01 was a Thursday (weekday 3)
+    weekdays = (created_ns // NS_PER_DAY + 3) % 7
+    weekend_counts = np.bincount(
+        hospital_codes, weights=weekdays >= 5, minlength=n_hospitals
+    )
+
+    # Same-day batching (hospital-level)
+    visit_days = visit_ns // NS_PER_DAY
+    order = np.lexsort((visit_days, hospital_codes))
+    visit_day_max = _max_run_per_group(
+        hospital_codes[order], visit_days[order], n_hospitals
+    )
+
+    for i in np.flatnonzero(visit_counts >= 2):
+        n = visit_counts[i]
+        pairs = total_pairs[i]
+
+        features[hospitals[i]] = {
+            "min_visit_gap_days": float(min_gap_days[i]) if pairs > 0 else None,
+            "short_gap_ratio": float(gap_violations[i] / pairs) if pairs > 0 else 0.0,
+            "hard_gap_violations": int(hard_violations[i]),
+            "median_delay_days": float(median_delay[i]) if delay_counts[i] else 0.0,
+            "p90_delay_days": float(p90_delay[i]) if delay_counts[i] else 0.0,
+            "submission_burstiness": float(burstiness[i]) if arrival_counts[i] else 0.0,
+            "same_hour_ratio": float(hour_counts[i].max() / n),
+            "weekend_ratio": float(weekend_counts[i] / n),
+            "same_day_visit_ratio": float(visit_day_max[i] / n),
+            "visit_count": int(n)
+        }
 
-        weekend_ratio = float((created_times.dt.weekday >= 5).mean())
+    return features
 
-        # Same-day batching (hospital-level)
-        visit_day_ratio = float(
-            visit_dates.dt.date.value_counts(normalize=True).iloc[0]
-        )
 
-        features[hospital_id] = {
-            "min_visit_gap_days": float(min_gap_days) if min_gap_days is not None else None,
-            "short_gap_ratio": float(short_gap_ratio),
-            "hard_gap_violations": int(hard_violations),
-            "median_delay_days": median_delay,
-            "p90_delay_days": p90_delay,
-            "submission_burstiness": burstiness,
-            "same_hour_ratio": same_hour_ratio,
-            "weekend_ratio": weekend_ratio,
-            "same_day_visit_ratio": visit_day_ratio,
-            "visit_count": int(len(hdf_visits))
-        }
+def extract_behavioral_features_streaming(chunks):
+    """
+    extract_behavioral_features over an iterable of trial chunks
+    (e.g. db.iter_locked_visits).
+
+    Every behavioral feature is visit-level, so only the first row of
+    each visit is kept while streaming (one row per visit instead of one
+    per value). Entry delays go into a QuantileSketch per hospital, so
+    median_delay_days / p90_delay_days are exact up to QUANTILE_SKETCH_K
+    visits per hospital and estimated beyond that; the other features
+    are exact.
+    """
+    visits = VisitTable()
+    delay_sketches = {}
+    for chunk in chunks:
+        new = visits.update(chunk)
+        if new is None:
+            continue
 
+        trial = as_trial_frame(new)
+        delays = _days(trial.created_ns - trial.visit_ns)
+        valid = delays >= 0
+        hospital_codes = trial.hospital_codes[valid]
+        delays = delays[valid]
+        for code in np.unique(hospital_codes):
+            hospital_id = trial.hospitals[code]
+            if hospital_id not in delay_sketches:
+                delay_sketches[hospital_id] = QuantileSketch()
+            delay_sketches[hospital_id].update(delays[hospital_codes == code])
+
+    df = visits.frame()
+    if df is None:
+        return {}
+
+    features = extract_behavioral_features(df)
+    for hospital_id, hospital_features in features.items():
+        sketch = delay_sketches.get(hospital_id)
+        if sketch is None:
+            continue
+        hospital_features["median_delay_days"] = sketch.quantile(0.5)
+        hospital_features["p90_delay_days"] = sketch.quantile(0.9)
     return features
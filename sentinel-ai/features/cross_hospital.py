@@ -1,10 +1,13 @@
 import numpy as np
 
+from config import PEER_SIZE_WEIGHT
+
 
 def extract_cross_hospital_features(
     statistical_results,
     behavioral_results,
-    cross_patient_results
+    cross_patient_results,
+    hospital_sizes=None
 ):
     """
     Builds hospital-level feature vectors.
@@ -15,8 +18,13 @@ def extract_cross_hospital_features(
         statistical_score,
         behavioral_score,
         cross_patient_score
+        (, size)
       ])
     }
+
+    With hospital_sizes ({hospital_id: visit_count}) a size feature
+    PEER_SIZE_WEIGHT * log10(1 + visit_count) is appended, on a fixed
+    scale so vectors stay comparable across trials.
     """
 
     hospital_vectors = {}
@@ -32,7 +40,13 @@ def extract_cross_hospital_features(
         beh = behavioral_results.get(hospital_id, {}).get("behavioral_score", 0.0)
         cp = cross_patient_results.get(hospital_id, {}).get("cross_patient_score", 0.0)
 
-        vector = np.array([stat, beh, cp], dtype=float)
+        vector = [stat, beh, cp]
+        if hospital_sizes is not None:
+            vector.append(
+                PEER_SIZE_WEIGHT * np.log10(1 + hospital_sizes.get(hospital_id, 0))
+            )
+
+        vector = np.array(vector, dtype=float)
 
         hospital_vectors[hospital_id] = vector
 
@@ -96,51 +96,92 @@
 #     return hospital_patient_vectors
 
 import numpy as np
-from collections import defaultdict
 
+from features.segments import segment_starts, segment_ids
+from features.trial_frame import as_trial_frame
 
-def extract_cross_patient_features(df):
+MIN_FIELD_VALUES = 2
+
+
+def extract_cross_patient_features(trial):
     """
     Build per-patient, per-field longitudinal signatures.
 
     Output format:
     {
       hospital_id: {
-        patient_id: {
-          field_id: {
-            first,
-            last,
-            slope,
-            std
-          }
-        }
+        "patient_ids": array (P,),
+        "field_ids": array (F,),
+        "first": array (P, F),
+        "last": array (P, F),
+        "slope": array (P, F),
+        "std": array (P, F)
       }
     }
-    """
-
-    df = df[df["value_number"].notna()].copy()
-    hospital_data = defaultdict(dict)
 
-    for hospital_id, hdf in df.groupby("hospital_id"):
-        for patient_id, pdf in hdf.groupby("patient_id"):
-            field_signatures = {}
+    Cells are NaN where the patient has fewer than two values for the
+    field. Only patients / fields with at least one signature are kept.
 
-            for field_id, fdf in pdf.groupby("crf_field_id"):
-                fdf = fdf.sort_values("visit_date")
-                values = fdf["value_number"].astype(float).values
-
-                # Need longitudinal info
-                if len(values) < 2:
-                    continue
-
-                field_signatures[field_id] = {
-                    "first": float(values[0]),
-                    "last": float(values[-1]),
-                    "slope": float(values[-1] - values[0]),
-                    "std": float(np.std(values))
-                }
-
-            if field_signatures:
-                hospital_data[hospital_id][patient_id] = field_signatures
+    trial is a TrialFrame (or a trial DataFrame). All (hospital,
+    patient, field) triples come from its (hospital, patient, field,
+    visit_date) sort and segment reductions.
+    """
 
-    return hospital_data
+    features = {}
+
+    trial = as_trial_frame(trial)
+    hospitals, patients, fields = trial.hospitals, trial.patients, trial.fields
+    order, starts, counts = trial.numeric_by_hospital_patient_field
+
+    values = trial.values[order]
+    hospital_codes = trial.hospital_codes[order]
+    patient_codes = trial.patient_codes[order]
+    field_codes = trial.field_codes[order]
+
+    # Need longitudinal info
+    longitudinal = counts >= MIN_FIELD_VALUES
+    if not longitudinal.any():
+        return features
+
+    in_signature = np.repeat(longitudinal, counts)
+    values = values[in_signature]
+    counts = counts[longitudinal]
+    starts = np.cumsum(counts) - counts
+    seg = segment_ids(starts, len(values))
+
+    sig_hospitals = hospital_codes[in_signature][starts]
+    sig_patients = patient_codes[in_signature][starts]
+    sig_fields = field_codes[in_signature][starts]
+
+    first = values[starts]
+    last = values[starts + counts - 1]
+    slope = last - first
+    means = np.add.reduceat(values, starts) / counts
+    stds = np.sqrt(np.add.reduceat((values - means[seg]) ** 2, starts) / counts)
+
+    # Signatures are sorted by hospital, so each hospital is a slice
+    hospital_starts = segment_starts(sig_hospitals)
+    hospital_ends = np.append(hospital_starts[1:], len(sig_hospitals))
+
+    for lo, hi in zip(hospital_starts, hospital_ends):
+        row_ids, rows = np.unique(sig_patients[lo:hi], return_inverse=True)
+        col_ids, cols = np.unique(sig_fields[lo:hi], return_inverse=True)
+        shape = (len(row_ids), len(col_ids))
+
+        signature = {
+            "patient_ids": np.asarray(patients[row_ids]),
+            "field_ids": np.asarray(fields[col_ids])
+        }
+        for name, column in (
+            ("first", first),
+            ("last", last),
+            ("slope", slope),
+            ("std", stds)
+        ):
+            grid = np.full(shape, np.nan)
+            grid[rows, cols] = column[lo:hi]
+            signature[name] = grid
+
+        features[hospitals[sig_hospitals[lo]]] = signature
+
+    return features
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+
+# ---------------------------
+# Segment helpers
+# ---------------------------
+#
+# Grouped reductions over arrays sorted by their group keys: every group
+# is a contiguous segment [start, start + count), so reductions run as
+# np.*.reduceat / offset arithmetic instead of a Python loop per group.
+
+def group_codes(series):
+    """
+    Integer codes + labels for an id column (category codes when the
+    column is already dictionary-encoded). Codes are widened to intp so
+    arithmetic on them (code * width + offset) cannot overflow.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy().astype(np.intp), series.cat.categories
+    codes, labels = pd.factorize(series, sort=True)
+    return codes, labels
+
+
+def segment_starts(*sorted_keys):
+    """
+    Start offsets of runs of equal key tuples in lexsorted key arrays.
+    """
+    n = len(sorted_keys[0])
+    change = np.zeros(n, dtype=bool)
+    if n:
+        change[0] = True
+        for keys in sorted_keys:
+            change[1:] |= keys[1:] != keys[:-1]
+    return np.flatnonzero(change)
+
+
+def segment_ids(starts, n):
+    """
+    Segment index of each of the n elements.
+    """
+    counts = np.diff(np.append(starts, n))
+    return np.repeat(np.arange(len(starts)), counts)
+
+
+def segment_quantile(sorted_values, starts, counts, q):
+    """
+    np.percentile(segment, q * 100) (linear method) for every segment
+    of an array sorted within each segment. Empty segments give NaN.
+    """
+    out = np.full(len(starts), np.nan)
+    ok = counts > 0
+    if not ok.any():
+        return out
+
+    starts, counts = starts[ok], counts[ok]
+
+    # Same virtual index and lerp as numpy's "linear" method
+    virtual = (counts - 1) * q
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous = np.clip(previous.astype(np.intp), 0, counts - 1)
+    following = np.clip(previous + 1, 0, counts - 1)
+
+    a = sorted_values[starts + previous]
+    b = sorted_values[starts + following]
+    diff = b - a
+    out[ok] = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    return out
@@ -1,15 +1,53 @@
 import numpy as np
-from scipy.stats import iqr, entropy
 
-def _rounding_ratio(values):
-    if len(values) == 0:
-        return 0.0
-    rounded = [v for v in values if v % 5 == 0]
-    return len(rounded) / len(values)
+from features.segments import (
+    segment_starts,
+    segment_ids,
+    segment_quantile
+)
+from features.trial_frame import as_trial_frame
+from features.accumulators import Moments, QuantileSketch
 
+MIN_GROUP_VALUES = 5
+HISTOGRAM_BINS = 10
 
 
-def extract_statistical_features(df):
+def _segment_entropy(values, starts, counts, seg):
+    """
+    scipy.stats.entropy(np.histogram(segment, bins=10)[0]) for every
+    segment of a segment-wise sorted array, binned the way np.histogram
+    bins each segment over its own [min, max].
+    """
+    n_seg = len(starts)
+    first = values[starts].astype(float)
+    last = values[starts + counts - 1].astype(float)
+
+    # np.histogram widens a zero range to [v - 0.5, v + 0.5]
+    flat = first == last
+    first[flat] -= 0.5
+    last[flat] += 0.5
+
+    edges = np.linspace(first, last, HISTOGRAM_BINS + 1, axis=1)
+
+    lo, hi = first[seg], last[seg]
+    idx = ((values - lo) / (hi - lo) * HISTOGRAM_BINS).astype(np.intp)
+    idx[idx == HISTOGRAM_BINS] -= 1
+
+    # Same edge corrections as np.histogram
+    idx[values < edges[seg, idx]] -= 1
+    idx[(values >= edges[seg, idx + 1]) & (idx != HISTOGRAM_BINS - 1)] += 1
+
+    hist = np.bincount(
+        seg * HISTOGRAM_BINS + idx, minlength=n_seg * HISTOGRAM_BINS
+    ).reshape(n_seg, HISTOGRAM_BINS)
+
+    p = hist / counts[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(p > 0, p * np.log(p), 0.0)
+    return -terms.sum(axis=1)
+
+
+def extract_statistical_features(trial):
     """
     Returns:
     {
@@ -19,27 +57,157 @@ def extract_statistical_features(df):
         }
       }
     }
+
+    trial is a TrialFrame (or a trial DataFrame). All (hospital, field)
+    groups are computed together from its (hospital, field, value) sort,
+    then segment reductions per group.
     """
     features = {}
 
-    grouped = df.groupby(["hospital_id", "crf_field_id"])
+    trial = as_trial_frame(trial)
+    hospitals, fields = trial.hospitals, trial.fields
+    order, starts, counts = trial.numeric_by_hospital_field
+
+    values = trial.values[order]
+    hospital_codes = trial.hospital_codes[order]
+    field_codes = trial.field_codes[order]
+
+    # too little data to judge
+    big = counts >= MIN_GROUP_VALUES
+    if not big.any():
+        return features
 
-    for (hospital_id, field_id), g in grouped:
-        values = g["value_number"].dropna().values
-        if len(values) < 5:
-            continue  # too little data to judge
+    in_big = np.repeat(big, counts)
+    values = values[in_big]
+    starts = segment_starts(hospital_codes[in_big], field_codes[in_big])
+    group_hospitals = hospital_codes[in_big][starts]
+    group_fields = field_codes[in_big][starts]
+    counts = counts[big]
+    seg = segment_ids(starts, len(values))
 
-        hist, _ = np.histogram(values, bins=10, density=True)
-        hist = hist[hist > 0]
+    means = np.add.reduceat(values, starts) / counts
+    stds = np.sqrt(np.add.reduceat((values - means[seg]) ** 2, starts) / counts)
+    iqrs = (
+        segment_quantile(values, starts, counts, 0.75)
+        - segment_quantile(values, starts, counts, 0.25)
+    )
+    entropies = _segment_entropy(values, starts, counts, seg)
+    rounding = np.add.reduceat(values % 5 == 0, starts) / counts
 
-        hospital_features = features.setdefault(hospital_id, {})
-        hospital_features[field_id] = {
-            "mean": float(np.mean(values)),
-            "std": float(np.std(values)),
-            "iqr": float(iqr(values)),
-            "entropy": float(entropy(hist)),
-            "rounding_ratio": _rounding_ratio(values),
-            "count": int(len(values))
+    for i in range(len(starts)):
+        hospital_features = features.setdefault(hospitals[group_hospitals[i]], {})
+        hospital_features[fields[group_fields[i]]] = {
+            "mean": float(means[i]),
+            "std": float(stds[i]),
+            "iqr": float(iqrs[i]),
+            "entropy": float(entropies[i]),
+            "rounding_ratio": float(rounding[i]),
+            "count": int(counts[i])
         }
 
     return features
+
+
+# ---------------------------
+# Streaming extraction
+# ---------------------------
+
+class _FieldAccumulator:
+    """
+    Running state of one (hospital, field) group.
+    """
+
+    def __init__(self):
+        self.moments = Moments()
+        self.sketch = QuantileSketch()
+        self.rounded = 0
+
+    def update(self, values):
+        self.moments.update(values)
+        self.sketch.update(values)
+        self.rounded += int(np.count_nonzero(values % 5 == 0))
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        self.rounded += other.rounded
+        return self
+
+    def features(self):
+        count = self.moments.count
+        return {
+            "mean": float(self.moments.mean),
+            "std": self.moments.std,
+            "iqr": self.sketch.quantile(0.75) - self.sketch.quantile(0.25),
+            "entropy": self.sketch.entropy(HISTOGRAM_BINS),
+            "rounding_ratio": self.rounded / count,
+            "count": int(count)
+        }
+
+
+class StatisticalState:
+    """
+    Mergeable statistical feature state of a trial, or of a shard of it
+    (a range of chunks, a set of hospitals, another process).
+
+    update() folds in a chunk, merge() folds in another state (merges
+    keep every sketch item uncompacted, so shards combine in any
+    grouping with the same result, up to float rounding) and features()
+    returns what extract_statistical_features returns, for
+    build_trial_baseline / detect_statistical_anomalies.
+
+    mean, std, count and rounding_ratio are exact; iqr and entropy are
+    exact for groups of up to QUANTILE_SKETCH_K values and estimated
+    from the quantile sketch beyond that. Entropy bins the sketch over
+    the group's merged [min, max], as np.histogram bins the raw values.
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def update(self, chunk):
+        trial = as_trial_frame(chunk)
+        order, starts, counts = trial.numeric_by_hospital_field
+        values = trial.values[order]
+
+        for start, count in zip(starts, counts):
+            row = order[start]
+            key = (
+                trial.hospitals[trial.hospital_codes[row]],
+                trial.fields[trial.field_codes[row]]
+            )
+            if key not in self.groups:
+                self.groups[key] = _FieldAccumulator()
+            self.groups[key].update(values[start:start + count])
+
+        return self
+
+    def merge(self, other):
+        for key, accumulator in other.groups.items():
+            if key in self.groups:
+                self.groups[key].merge(accumulator)
+            else:
+                # Copy, so later updates here never touch other
+                self.groups[key] = _FieldAccumulator().merge(accumulator)
+        return self
+
+    def features(self):
+        features = {}
+        for (hospital_id, field_id), accumulator in sorted(self.groups.items()):
+            # too little data to judge
+            if accumulator.moments.count < MIN_GROUP_VALUES:
+                continue
+            features.setdefault(hospital_id, {})[field_id] = accumulator.features()
+        return features
+
+
+def extract_statistical_features_streaming(chunks):
+    """
+    extract_statistical_features over an iterable of trial chunks
+    (e.g. db.iter_locked_visits), in memory bounded by the number of
+    (hospital, field) groups rather than the number of values.
+    """
+    state = StatisticalState()
+    for chunk in chunks:
+        state.update(chunk)
+    return state.features()
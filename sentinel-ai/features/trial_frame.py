@@ -0,0 +1,135 @@
+from collections import namedtuple
+from functools import cached_property
+
+import numpy as np
+
+from features.segments import group_codes, segment_starts
+
+
+# ---------------------------
+# Shared per-run preprocessing
+# ---------------------------
+#
+# Built once per run and handed to every extractor, so the id codes,
+# timestamps, visit-level dedup and the group sorts are paid once per
+# trial. Sorts are computed lazily on first use and then cached.
+
+# order:  row indices (into the frame's arrays) in group-sorted order
+# starts: offset of each group in order
+# counts: rows per group
+Groups = namedtuple("Groups", ["order", "starts", "counts"])
+
+
+def _groups(order, *keys):
+    """
+    Groups over rows `order`, sorted by keys (each indexed by row).
+    """
+    starts = segment_starts(*(key[order] for key in keys))
+    counts = np.diff(np.append(starts, len(order)))
+    return Groups(order, starts, counts)
+
+
+class TrialFrame:
+    """
+    One trial's locked visit values (compact schema) as integer codes
+    and int64 timestamps, with cached group indexes:
+
+        numeric_by_hospital_field     value rows by (hospital, field, value)
+        numeric_by_hospital_patient_field
+                                      value rows by (hospital, patient,
+                                      field, visit_date)
+        visits                        first row of every visit
+        visits_by_hospital            visit rows by hospital
+        visits_by_hospital_patient    visit rows by (hospital, patient,
+                                      visit_date)
+
+    "value rows" are the rows with a non-null value_number.
+    """
+
+    def __init__(self, df):
+        self.df = df
+
+        self.hospital_codes, self.hospitals = group_codes(df["hospital_id"])
+        self.patient_codes, self.patients = group_codes(df["patient_id"])
+        self.field_codes, self.fields = group_codes(df["crf_field_id"])
+        self.visit_codes, _ = group_codes(df["visit_id"])
+
+        self.values = df["value_number"].to_numpy(dtype=float)
+        self.visit_ns = df["visit_date"].to_numpy(dtype=np.int64)
+        self.created_ns = df["created_at"].to_numpy(dtype=np.int64)
+
+    def __len__(self):
+        return len(self.df)
+
+    @property
+    def empty(self):
+        return self.df.empty
+
+    # ---------------------------
+    # Value rows
+    # ---------------------------
+
+    @cached_property
+    def numeric(self):
+        return np.flatnonzero(~np.isnan(self.values))
+
+    @cached_property
+    def numeric_by_hospital_field(self):
+        rows = self.numeric
+        order = rows[np.lexsort((
+            self.values[rows],
+            self.field_codes[rows],
+            self.hospital_codes[rows]
+        ))]
+        return _groups(order, self.hospital_codes, self.field_codes)
+
+    @cached_property
+    def numeric_by_hospital_patient_field(self):
+        rows = self.numeric
+        order = rows[np.lexsort((
+            self.visit_ns[rows],
+            self.field_codes[rows],
+            self.patient_codes[rows],
+            self.hospital_codes[rows]
+        ))]
+        return _groups(
+            order, self.hospital_codes, self.patient_codes, self.field_codes
+        )
+
+    # ---------------------------
+    # Visit rows
+    # ---------------------------
+
+    @cached_property
+    def visits(self):
+        """
+        Index of the first row of every visit, in frame order
+        (same rows as df.drop_duplicates(subset=["visit_id"])).
+        """
+        _, first = np.unique(self.visit_codes, return_index=True)
+        return np.sort(first)
+
+    @cached_property
+    def visits_by_hospital(self):
+        rows = self.visits
+        order = rows[np.argsort(self.hospital_codes[rows], kind="stable")]
+        return _groups(order, self.hospital_codes)
+
+    @cached_property
+    def visits_by_hospital_patient(self):
+        rows = self.visits
+        order = rows[np.lexsort((
+            self.visit_ns[rows],
+            self.patient_codes[rows],
+            self.hospital_codes[rows]
+        ))]
+        return _groups(order, self.hospital_codes, self.patient_codes)
+
+
+def as_trial_frame(data):
+    """
+    Extractors accept either a TrialFrame or a plain trial DataFrame.
+    """
+    if isinstance(data, TrialFrame):
+        return data
+    return TrialFrame(data)
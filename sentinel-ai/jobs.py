@@ -0,0 +1,166 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from config import RUN_AI_WORKERS, RUN_AI_JOB_HISTORY
+from runner import open_ai_run, run_ai_for_trial
+
+
+# ---------------------------
+# Background AI runs
+# ---------------------------
+#
+# POST /run-ai submits a run here and returns its ai_run_id at once;
+# the run computes on a small thread pool and GET /runs/{id} reads its
+# progress. A trial has at most one run in flight: submitting it again
+# returns the run already queued or running.
+#
+# Jobs live in this process only. Finished ones are kept (up to
+# RUN_AI_JOB_HISTORY) for status reads; older runs are read from ai_runs.
+
+_executor = None
+_executor_pid = None
+
+_lock = threading.Lock()
+_jobs = OrderedDict()   # ai_run_id -> job, oldest first
+_in_flight = {}         # trial_id -> ai_run_id (an Event while it is opened)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    # Called under _lock. A forked child must not reuse the parent's threads
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(
+            max_workers=RUN_AI_WORKERS, thread_name_prefix="ai-run"
+        )
+        _executor_pid = os.getpid()
+
+    return _executor
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _update(ai_run_id, **changes):
+    with _lock:
+        _jobs[ai_run_id].update(changes)
+
+
+def _run(job_id):
+    with _lock:
+        job = _jobs[job_id]
+        trial_id, triggered_by = job["trial_id"], job["triggered_by"]
+
+    _update(job_id, status="running", started_at=_now())
+
+    def progress(step, done, total):
+        _update(job_id, step=step, progress=round(done / total, 3))
+
+    try:
+        ai_run_id = run_ai_for_trial(
+            trial_id,
+            triggered_by=triggered_by,
+            ai_run_id=job_id,
+            progress=progress
+        )
+        if ai_run_id is None:
+            _update(job_id, status="failed", error="No locked visits found.")
+        else:
+            _record_run_id(job_id, ai_run_id)
+            _update(job_id, status="completed")
+    except Exception as e:
+        _record_run_id(job_id, getattr(e, "ai_run_id", job_id))
+        _update(job_id, status="failed", error=str(e))
+    finally:
+        with _lock:
+            _jobs[job_id]["finished_at"] = _now()
+            if _in_flight.get(trial_id) == job_id:
+                del _in_flight[trial_id]
+            _forget_finished()
+
+
+def _record_run_id(job_id, ai_run_id):
+    # A reopened run whose data changed before it started is recorded as
+    # a new run; the job is then reachable under both ids
+    ai_run_id = str(ai_run_id)
+    if ai_run_id == job_id:
+        return
+    with _lock:
+        _jobs[job_id]["ai_run_id"] = ai_run_id
+        _jobs[ai_run_id] = _jobs[job_id]
+
+
+def _forget_finished():
+    # Called under _lock; drops the oldest finished jobs beyond the limit
+    finished = [k for k, job in _jobs.items() if job["finished_at"] is not None]
+    for ai_run_id in finished[:max(0, len(finished) - RUN_AI_JOB_HISTORY)]:
+        del _jobs[ai_run_id]
+
+
+def submit_run(trial_id, triggered_by=None):
+    """
+    Queues an AI run for the trial, or joins the one already in flight.
+
+    Returns (job, coalesced): a copy of the job and whether it is an
+    existing run rather than a new one.
+    """
+    trial_id = str(trial_id)
+
+    while True:
+        with _lock:
+            current = _in_flight.get(trial_id)
+            if current is None:
+                # Reserve the trial while its ai_runs row is created
+                opening = threading.Event()
+                _in_flight[trial_id] = opening
+                break
+            if not isinstance(current, threading.Event):
+                return dict(_jobs[current]), True
+
+        # Another request is opening this trial's run: wait for its id
+        current.wait()
+
+    # The ai_runs row is created up front so its id can be returned.
+    # Outside _lock: status reads and progress updates never wait on
+    # the connection pool.
+    try:
+        ai_run_id = str(open_ai_run(trial_id, triggered_by=triggered_by))
+    except Exception:
+        with _lock:
+            del _in_flight[trial_id]
+        opening.set()
+        raise
+
+    with _lock:
+        _jobs[ai_run_id] = {
+            "ai_run_id": ai_run_id,
+            "trial_id": trial_id,
+            "triggered_by": triggered_by,
+            "status": "queued",
+            "step": None,
+            "progress": 0.0,
+            "submitted_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None
+        }
+        _in_flight[trial_id] = ai_run_id
+        job = dict(_jobs[ai_run_id])
+
+        _get_executor().submit(_run, ai_run_id)
+
+    opening.set()
+    return job, False
+
+
+def get_run(ai_run_id):
+    """
+    A copy of the job, or None if this process has no record of it.
+    """
+    with _lock:
+        job = _jobs.get(str(ai_run_id))
+        return dict(job) if job is not None else None
@@ -0,0 +1,259 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager, ExitStack
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from config import TRIAL_STATE_DIR, DELTA_LOOKBACK_MINUTES
+from db import (
+    fetch_locked_visits,
+    fetch_locked_visits_for_trials,
+    count_locked_values,
+    count_locked_values_for_trials,
+    VISIT_COLUMNS
+)
+from schema import ID_COLUMNS, concat_frames
+
+
+# ---------------------------
+# Columnar snapshot on disk
+# ---------------------------
+#
+# TRIAL_STATE_DIR/<trial_id>/
+#     meta.json              row count, watermark, segment list
+#     seg_00000/<col>.npy    one uncompressed .npy per column; id columns
+#                            as <col>.codes.npy + <col>.categories.npy
+# TRIAL_STATE_DIR/<trial_id>.lock
+#
+# Columns are plain .npy files so they can be memory-mapped on reload.
+# A delta load rewrites the snapshot as a single segment, so a reload
+# maps it without copying (several segments would have to be
+# concatenated into RAM).
+#
+# The cron and background runs can load the same trial at once, from
+# threads or processes, so a trial's read-refresh-write holds an
+# exclusive flock on its lock file. The lock file sits next to the
+# snapshot directory, not in it, because full rewrites swap the whole
+# directory.
+
+def _snapshot_dir(trial_id):
+    return os.path.join(TRIAL_STATE_DIR, str(trial_id))
+
+
+@contextmanager
+def _snapshot_lock(trial_id):
+    os.makedirs(TRIAL_STATE_DIR, exist_ok=True)
+    with open(os.path.join(TRIAL_STATE_DIR, f"{trial_id}.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_meta(trial_id):
+    path = os.path.join(_snapshot_dir(trial_id), "meta.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_meta(snapshot_dir, meta):
+    # Write-then-rename so a crash never leaves a truncated meta file
+    path = os.path.join(snapshot_dir, "meta.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+
+def _write_segment(snapshot_dir, name, df):
+    seg_dir = os.path.join(snapshot_dir, name)
+    os.makedirs(seg_dir, exist_ok=True)
+
+    for col in VISIT_COLUMNS:
+        if col in ID_COLUMNS:
+            values = df[col].cat
+            np.save(
+                os.path.join(seg_dir, f"{col}.codes.npy"),
+                values.codes.to_numpy().astype("int32")
+            )
+            np.save(
+                os.path.join(seg_dir, f"{col}.categories.npy"),
+                values.categories.to_numpy().astype(str)
+            )
+        else:
+            np.save(os.path.join(seg_dir, f"{col}.npy"), df[col].to_numpy())
+
+
+def _read_segment(trial_id, name):
+    seg_dir = os.path.join(_snapshot_dir(trial_id), name)
+
+    columns = {}
+    for col in VISIT_COLUMNS:
+        if col in ID_COLUMNS:
+            columns[col] = pd.Categorical.from_codes(
+                np.load(os.path.join(seg_dir, f"{col}.codes.npy"), mmap_mode="r"),
+                categories=np.load(os.path.join(seg_dir, f"{col}.categories.npy"))
+            )
+        else:
+            columns[col] = np.load(
+                os.path.join(seg_dir, f"{col}.npy"), mmap_mode="r"
+            )
+
+    # copy=False keeps value and timestamp columns backed by the mmap
+    return pd.DataFrame(columns, columns=VISIT_COLUMNS, copy=False)
+
+
+def _write_snapshot(trial_id, df):
+    """
+    Replaces the trial snapshot with a single segment holding df.
+
+    The new snapshot is built in a temporary directory and swapped in
+    by renames, so a failed write leaves the old snapshot untouched.
+    """
+    snapshot_dir = _snapshot_dir(trial_id)
+    build_dir = tempfile.mkdtemp(prefix=f".{trial_id}.", dir=TRIAL_STATE_DIR)
+
+    try:
+        _write_segment(build_dir, "seg_00000", df)
+        _write_meta(build_dir, {
+            "rows": int(len(df)),
+            "watermark": pd.Timestamp(df["created_at"].max()).isoformat(),
+            "segments": ["seg_00000"]
+        })
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    # A directory cannot be renamed over a non-empty one: move the old
+    # snapshot aside first (frames still mapping its files keep them)
+    old_dir = build_dir + ".old"
+    if os.path.exists(snapshot_dir):
+        os.replace(snapshot_dir, old_dir)
+    os.replace(build_dir, snapshot_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _read_snapshot(trial_id, meta):
+    if len(meta["segments"]) == 1:
+        return _read_segment(trial_id, meta["segments"][0])
+
+    # Snapshots from before delta loads were compacted can still hold
+    # appended segments; fold them into one so later reloads are mapped
+    _write_snapshot(trial_id, concat_frames([
+        _read_segment(trial_id, name) for name in meta["segments"]
+    ]))
+    return _read_segment(trial_id, "seg_00000")
+
+
+def _as_utc(ts):
+    return pd.Timestamp(ts).tz_localize("UTC").to_pydatetime()
+
+
+# ---------------------------
+# Loader
+# ---------------------------
+
+def _delta_since(meta):
+    watermark = pd.Timestamp(meta["watermark"])
+    return watermark - timedelta(minutes=DELTA_LOOKBACK_MINUTES)
+
+
+def _refresh_snapshot(trial_id, meta, fetched):
+    """
+    Turns a fetch result into the full trial frame.
+
+    meta is None when the whole trial was fetched; otherwise fetched
+    holds the rows since _delta_since(meta), appended to the snapshot.
+    """
+    if meta is None:
+        if not fetched.empty:
+            _write_snapshot(trial_id, fetched)
+        return fetched
+
+    since = _delta_since(meta)
+    delta = fetched
+    df = _read_snapshot(trial_id, meta)
+
+    if not delta.empty:
+        # The lookback window overlaps the snapshot; keep only unseen rows
+        recent = df[df["created_at"] > since.value]
+        seen = pd.MultiIndex.from_frame(recent[["visit_id", "crf_field_id"]])
+        keys = pd.MultiIndex.from_frame(delta[["visit_id", "crf_field_id"]])
+        delta = delta[~keys.isin(seen)]
+
+    if delta.empty:
+        return df
+
+    print(f"Delta load ({trial_id}): {len(delta)} new rows since {meta['watermark']}")
+    _write_snapshot(trial_id, concat_frames([df, delta]))
+    return _read_segment(trial_id, "seg_00000")
+
+
+def load_trial_visits(trial_id):
+    """
+    Returns all locked visit values for the trial.
+
+    The trial is cached locally as a columnar snapshot. The snapshot is
+    reused if its fingerprint (row count up to its watermark) still
+    matches the database; then only visits created after the watermark
+    are fetched and appended. Otherwise the whole trial is refetched.
+    """
+    with _snapshot_lock(trial_id):
+        meta = _read_meta(trial_id)
+
+        if meta is not None:
+            watermark = pd.Timestamp(meta["watermark"])
+            if count_locked_values(trial_id, _as_utc(watermark)) != meta["rows"]:
+                print("Snapshot fingerprint mismatch, refetching trial.")
+                meta = None
+
+        if meta is None:
+            fetched = fetch_locked_visits(trial_id)
+        else:
+            fetched = fetch_locked_visits(trial_id, since=_as_utc(_delta_since(meta)))
+
+        return _refresh_snapshot(trial_id, meta, fetched)
+
+
+def load_trials_visits(trial_ids):
+    """
+    Batched load_trial_visits for the daily cron.
+
+    Fingerprints are checked in one query and all full/delta fetches
+    share one more, partitioned per trial in memory.
+
+    Returns: {trial_id: DataFrame}
+    """
+    with ExitStack() as locks:
+        # Sorted, so two batches sharing trials never wait on each other
+        for trial_id in sorted(set(map(str, trial_ids))):
+            locks.enter_context(_snapshot_lock(trial_id))
+
+        metas = {trial_id: _read_meta(trial_id) for trial_id in trial_ids}
+
+        counts = count_locked_values_for_trials({
+            trial_id: _as_utc(pd.Timestamp(meta["watermark"]))
+            for trial_id, meta in metas.items()
+            if meta is not None
+        })
+        for trial_id, count in counts.items():
+            if count != metas[trial_id]["rows"]:
+                print(f"Snapshot fingerprint mismatch ({trial_id}), refetching trial.")
+                metas[trial_id] = None
+
+        fetched = fetch_locked_visits_for_trials({
+            trial_id: None if meta is None else _as_utc(_delta_since(meta))
+            for trial_id, meta in metas.items()
+        })
+
+        return {
+            trial_id: _refresh_snapshot(trial_id, metas[trial_id], fetched[trial_id])
+            for trial_id in trial_ids
+        }
@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from config import HOSPITAL_WORKERS
+from features.trial_frame import as_trial_frame
+from schema import ID_COLUMNS
+
+
+# ---------------------------
+# Per-hospital fan-out
+# ---------------------------
+#
+# Hospital-local work (feature extraction, the cross-patient detector)
+# can run on a process pool: the trial is split into shards of whole
+# hospitals, each shard goes to a worker, and the per-hospital results
+# are merged back in the order the serial path produces them.
+# Steps that look across hospitals (baselines, Task 4) stay in the
+# calling process.
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Shards per TrialFrame, so Tasks 1-3 split a trial only once
+_shard_cache = weakref.WeakKeyDictionary()
+_shard_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        # A forked child must not reuse the parent's worker processes
+        if _executor is None or _executor_pid != os.getpid():
+            # Created from stage / cron worker threads: forking this
+            # multi-threaded process could copy locks held mid-update
+            # into the children, so workers start from a fork server
+            _executor = ProcessPoolExecutor(
+                max_workers=HOSPITAL_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+            _executor_pid = os.getpid()
+
+    return _executor
+
+
+def hospital_shards(trial, n_shards):
+    """
+    Splits the trial's rows into at most n_shards DataFrames of whole
+    hospitals, balanced by row count (largest hospitals placed first,
+    each on the lightest shard). Deterministic for a given trial.
+    """
+    sizes = np.bincount(trial.hospital_codes, minlength=len(trial.hospitals))
+    hospitals = np.flatnonzero(sizes)
+
+    shard_of = np.full(len(trial.hospitals), -1)
+    load = np.zeros(min(n_shards, len(hospitals)), dtype=np.int64)
+    for code in hospitals[np.argsort(-sizes[hospitals], kind="stable")]:
+        shard = int(np.argmin(load))
+        shard_of[code] = shard
+        load[shard] += sizes[code]
+
+    row_shards = shard_of[trial.hospital_codes]
+    return [
+        _trimmed(trial.df.iloc[np.flatnonzero(row_shards == shard)])
+        for shard in range(len(load))
+    ]
+
+
+def _trimmed(shard):
+    # A row subset keeps the trial's full id dictionaries; drop the ids
+    # this shard never uses so workers are not sent every id in the trial
+    shard = shard.reset_index(drop=True)
+    for col in ID_COLUMNS:
+        if col in shard and isinstance(shard[col].dtype, pd.CategoricalDtype):
+            shard[col] = shard[col].cat.remove_unused_categories()
+    return shard
+
+
+def map_hospitals(func, trial):
+    """
+    func(trial) for a hospital-local func returning {hospital_id: ...},
+    fanned out over HOSPITAL_WORKERS processes when that is above 1.
+
+    func must be a module-level function (it is pickled by name). The
+    merged result has the same content and key order as func(trial).
+    """
+    trial = as_trial_frame(trial)
+    if HOSPITAL_WORKERS <= 1 or len(trial.hospitals) <= 1:
+        return func(trial)
+
+    with _shard_lock:
+        if trial not in _shard_cache:
+            _shard_cache[trial] = hospital_shards(trial, HOSPITAL_WORKERS)
+        shards = _shard_cache[trial]
+
+    parts = list(_get_executor().map(func, shards))
+
+    merged = {}
+    for part in parts:
+        merged.update(part)
+
+    # Serial order: hospitals in code order
+    return {
+        hospital_id: merged[hospital_id]
+        for hospital_id in trial.hospitals
+        if hospital_id in merged
+    }
@@ -0,0 +1,80 @@
+import queue
+import threading
+
+from config import PERSIST_QUEUE_SIZE
+from checkpoints import clear_checkpoints
+from persistence.writer import save_run_results, finalize_ai_run
+
+
+class WriteBehindQueue:
+    """
+    Persists finished AI runs on a dedicated writer thread, so the
+    caller can start computing the next trial while the previous one
+    is still being written.
+
+    The queue is bounded: submit() blocks once PERSIST_QUEUE_SIZE runs
+    are waiting, which keeps computed-but-unwritten results in check.
+    A run whose write fails is marked failed in ai_runs and reported
+    by close().
+
+    Usage:
+        with WriteBehindQueue() as writer:
+            run_ai_for_trial(trial_id, writer=writer)
+        writer.failures  # [(ai_run_id, exception), ...]
+    """
+
+    def __init__(self, maxsize=PERSIST_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.failures = []
+        self._thread = threading.Thread(
+            target=self._drain, name="ai-run-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, **run_results):
+        """
+        Queues the keyword arguments of one save_run_results call.
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError("Writer thread is not running")
+        self._queue.put(run_results)
+
+    def _drain(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(job)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, job):
+        ai_run_id = job["ai_run_id"]
+        try:
+            save_run_results(**job)
+            clear_checkpoints(ai_run_id)
+            print(f"AI run persisted: {ai_run_id}")
+        except Exception as e:
+            print(f"AI run {ai_run_id} failed to persist:", str(e))
+            self.failures.append((ai_run_id, e))
+            try:
+                finalize_ai_run(ai_run_id, status="failed")
+            except Exception as finalize_error:
+                print(f"Could not mark AI run {ai_run_id} failed:", str(finalize_error))
+
+    def close(self):
+        """
+        Waits for every queued run to be written; returns the failures.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        return self.failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
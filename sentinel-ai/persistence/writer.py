@@ -1,14 +1,6 @@
-import psycopg2
 from datetime import datetime
-from config import DB_URL
-
-
-# ---------------------------
-# Connection helper
-# ---------------------------
-
-def get_conn():
-    return psycopg2.connect(DB_URL)
+from psycopg2.extras import execute_values
+from db import get_connection
 
 
 # ---------------------------
@@ -25,29 +17,28 @@ def create_ai_run(
     """
     Creates an AI run entry and returns ai_run_id
     """
-    conn = get_conn()
-    cur = conn.cursor()
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    cur.execute(
-        """
-        INSERT INTO ai_runs (
-            trial_id,
-            triggered_by,
-            trigger_type,
-            ai_version,
-            status,
-            notes
+        cur.execute(
+            """
+            INSERT INTO ai_runs (
+                trial_id,
+                triggered_by,
+                trigger_type,
+                ai_version,
+                status,
+                notes
+            )
+            VALUES (%s, %s, %s, %s, 'running', %s)
+            RETURNING id
+            """,
+            (trial_id, triggered_by, trigger_type, ai_version, notes)
         )
-        VALUES (%s, %s, %s, %s, 'running', %s)
-        RETURNING id
-        """,
-        (trial_id, triggered_by, trigger_type, ai_version, notes)
-    )
 
-    ai_run_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
+        ai_run_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
 
     return ai_run_id
 
@@ -56,22 +47,49 @@ def finalize_ai_run(ai_run_id, status="completed"):
     """
     Marks AI run as completed or failed
     """
-    conn = get_conn()
-    cur = conn.cursor()
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    cur.execute(
-        """
-        UPDATE ai_runs
-        SET status = %s,
-            completed_at = %s
-        WHERE id = %s
-        """,
-        (status, datetime.utcnow(), ai_run_id)
-    )
+        cur.execute(
+            """
+            UPDATE ai_runs
+            SET status = %s,
+                completed_at = %s
+            WHERE id = %s
+            """,
+            (status, datetime.utcnow(), ai_run_id)
+        )
+
+        conn.commit()
+        cur.close()
+
+
+def reopen_ai_run(ai_run_id):
+    """
+    Puts a failed AI run back to running for a resumed retry.
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    Returns False if the run is no longer failed (another retry claimed
+    it first), so only one caller ever resumes a run.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            UPDATE ai_runs
+            SET status = 'running',
+                completed_at = NULL
+            WHERE id = %s
+              AND status = 'failed'
+            """,
+            (ai_run_id,)
+        )
+        claimed = cur.rowcount == 1
+
+        conn.commit()
+        cur.close()
+
+    return claimed
 
 
 def save_hospital_scores(
@@ -91,40 +109,39 @@ def save_hospital_scores(
     }
     """
 
-    conn = get_conn()
-    cur = conn.cursor()
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    cur.execute(
-        """
-        INSERT INTO ai_hospital_scores (
-            ai_run_id,
-            trial_id,
-            hospital_id,
-            risk_score,
-            risk_level,
-            statistical_score,
-            behavioral_score,
-            cross_patient_score,
-            peer_deviation_score
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """,
-        (
-            ai_run_id,
-            trial_id,
-            hospital_id,
-            risk_score,
-            risk_level,
-            scores.get("statistical"),
-            scores.get("behavioral"),
-            scores.get("cross_patient"),
-            scores.get("peer_deviation"),
+        cur.execute(
+            """
+            INSERT INTO ai_hospital_scores (
+                ai_run_id,
+                trial_id,
+                hospital_id,
+                risk_score,
+                risk_level,
+                statistical_score,
+                behavioral_score,
+                cross_patient_score,
+                peer_deviation_score
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            (
+                ai_run_id,
+                trial_id,
+                hospital_id,
+                risk_score,
+                risk_level,
+                scores.get("statistical"),
+                scores.get("behavioral"),
+                scores.get("cross_patient"),
+                scores.get("peer_deviation"),
+            )
         )
-    )
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
+        cur.close()
 
 
 def save_anomaly_signals(
@@ -148,36 +165,164 @@ def save_anomaly_signals(
     if not signals:
         return
 
-    conn = get_conn()
-    cur = conn.cursor()
+    with get_connection() as conn:
+        cur = conn.cursor()
+
+        for signal in signals:
+            cur.execute(
+                """
+                INSERT INTO ai_anomaly_signals (
+                    ai_run_id,
+                    trial_id,
+                    hospital_id,
+                    signal_type,
+                    signal_key,
+                    affected_field,
+                    anomaly_score,
+                    explanation
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                """,
+                (
+                    ai_run_id,
+                    trial_id,
+                    hospital_id,
+                    signal["type"],
+                    signal["key"],
+                    signal.get("field"),
+                    signal["score"],
+                    signal["explanation"]
+                )
+            )
+
+        conn.commit()
+        cur.close()
+
+
+# ---------------------------
+# Bulk path (one transaction per run)
+# ---------------------------
+
+def save_run_results(
+    ai_run_id,
+    trial_id,
+    hospital_scores,
+    signals,
+    status="completed"
+):
+    """
+    Writes a whole run's ai_hospital_scores and ai_anomaly_signals and
+    finalizes the ai_runs row in a single transaction, so a run is
+    either fully persisted or not at all.
+
+    Rows already stored for ai_run_id are replaced, so retrying a run
+    never duplicates them.
+
+    hospital_scores = [
+        {
+            "hospital_id": ...,
+            "scores": {...},          # as in save_hospital_scores
+            "risk_score": 42.5,
+            "risk_level": "MEDIUM"
+        }
+    ]
+
+    signals = [
+        {"hospital_id": ..., **signal}   # signal as in save_anomaly_signals
+    ]
+    """
+
+    score_rows = [
+        (
+            ai_run_id,
+            trial_id,
+            row["hospital_id"],
+            row["risk_score"],
+            row["risk_level"],
+            row["scores"].get("statistical"),
+            row["scores"].get("behavioral"),
+            row["scores"].get("cross_patient"),
+            row["scores"].get("peer_deviation"),
+        )
+        for row in hospital_scores
+    ]
+
+    signal_rows = [
+        (
+            ai_run_id,
+            trial_id,
+            signal["hospital_id"],
+            signal["type"],
+            signal["key"],
+            signal.get("field"),
+            signal["score"],
+            signal["explanation"]
+        )
+        for signal in signals
+    ]
+
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    for signal in signals:
         cur.execute(
-            """
-            INSERT INTO ai_anomaly_signals (
-                ai_run_id,
-                trial_id,
-                hospital_id,
-                signal_type,
-                signal_key,
-                affected_field,
-                anomaly_score,
-                explanation
+            "DELETE FROM ai_anomaly_signals WHERE ai_run_id = %s",
+            (ai_run_id,)
+        )
+        cur.execute(
+            "DELETE FROM ai_hospital_scores WHERE ai_run_id = %s",
+            (ai_run_id,)
+        )
+
+        if score_rows:
+            execute_values(
+                cur,
+                """
+                INSERT INTO ai_hospital_scores (
+                    ai_run_id,
+                    trial_id,
+                    hospital_id,
+                    risk_score,
+                    risk_level,
+                    statistical_score,
+                    behavioral_score,
+                    cross_patient_score,
+                    peer_deviation_score
+                )
+                VALUES %s
+                """,
+                score_rows,
+                page_size=1000
             )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """,
-            (
-                ai_run_id,
-                trial_id,
-                hospital_id,
-                signal["type"],
-                signal["key"],
-                signal.get("field"),
-                signal["score"],
-                signal["explanation"]
+
+        if signal_rows:
+            execute_values(
+                cur,
+                """
+                INSERT INTO ai_anomaly_signals (
+                    ai_run_id,
+                    trial_id,
+                    hospital_id,
+                    signal_type,
+                    signal_key,
+                    affected_field,
+                    anomaly_score,
+                    explanation
+                )
+                VALUES %s
+                """,
+                signal_rows,
+                page_size=1000
             )
+
+        cur.execute(
+            """
+            UPDATE ai_runs
+            SET status = %s,
+                completed_at = %s
+            WHERE id = %s
+            """,
+            (status, datetime.utcnow(), ai_run_id)
         )
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
+        cur.close()
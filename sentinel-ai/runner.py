@@ -1,23 +1,54 @@
-from db import fetch_locked_visits
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+from config import (
+    DETECTOR_MODE,
+    CROSS_HOSPITAL_MODE,
+    PEER_SIZE_FEATURES,
+    PEER_INDEX_PATH,
+    ENABLED_DETECTORS,
+    STAGE_WORKERS
+)
+from loader import load_trial_visits
+from db import fetch_latest_finished_run, fetch_ai_run, count_locked_values
+from checkpoints import (
+    frame_fingerprint,
+    read_fingerprint,
+    checkpoints_cover,
+    start_checkpoints,
+    run_stage,
+    clear_checkpoints
+)
 
+from features.trial_frame import TrialFrame
+from parallel import map_hospitals
+from scheduler import Stage, required_stages, run_stages
 from features.statistical import extract_statistical_features
 from detectors.statistical import (
     build_trial_baseline,
-    detect_statistical_anomalies
+    detect_statistical_anomalies,
+    stack_statistical_features,
+    build_trial_baseline_matrix,
+    detect_statistical_anomalies_matrix
 )
 
 from features.behavioral import extract_behavioral_features
 from detectors.behavioral import (
     build_behavioral_baseline,
-    detect_behavioral_anomalies
+    detect_behavioral_anomalies,
+    stack_behavioral_features,
+    build_behavioral_baseline_matrix,
+    detect_behavioral_anomalies_matrix
 )
 
 
 
 from persistence.writer import (
     create_ai_run,
-    save_hospital_scores,
-    save_anomaly_signals,
+    reopen_ai_run,
+    save_run_results,
     finalize_ai_run
 )
 
@@ -25,97 +56,320 @@ from features.cross_patient import extract_cross_patient_features
 from detectors.cross_patient import detect_cross_patient_templating
 
 from features.cross_hospital import extract_cross_hospital_features
-from detectors.cross_hospital import detect_cross_hospital_deviation
+from detectors.cross_hospital import (
+    detect_cross_hospital_deviation,
+    detect_peer_group_deviation,
+    PeerIndex
+)
 
-def run_ai_for_trial(trial_id, triggered_by=None):
-    # 1. Fetch immutable data
-    df = fetch_locked_visits(trial_id)
 
-    if df.empty:
-        print("No locked visits found.")
-        return
+# -----------------------------
+# Stages (each one is checkpointed)
+# -----------------------------
 
-    # 2. Create AI run
-    ai_run_id = create_ai_run(
-        trial_id=trial_id,
-        ai_version="v1.0",
-        trigger_type="manual",
-        triggered_by=triggered_by,
-        notes="Task 1 + Task 2 analysis"
-    )
-
-    print(f"AI run started: {ai_run_id}")
+def _task1_statistical(trial):
+    stat_features = map_hospitals(extract_statistical_features, trial)
 
-    try:
-        # -----------------------------
-        # Task 1: Statistical anomalies
-        # -----------------------------
-        stat_features = extract_statistical_features(df)
-        stat_baseline = build_trial_baseline(stat_features)
-        task1_results = detect_statistical_anomalies(
-            stat_features, stat_baseline
+    if DETECTOR_MODE == "matrix":
+        stat_matrix = stack_statistical_features(stat_features)
+        stat_baseline = build_trial_baseline_matrix(stat_matrix)
+        return detect_statistical_anomalies_matrix(
+            stat_matrix, stat_baseline, stat_features
         )
 
-        # -----------------------------
-        # Task 2: Behavioral anomalies
-        # -----------------------------
-        behavioral_features = extract_behavioral_features(df)
-
-        # if behavioral_features:
-        #     behavioral_baseline = build_behavioral_baseline(
-        #         behavioral_features
-        #     )
-        #     task2_results = detect_behavioral_anomalies(
-        #         behavioral_features,
-        #         behavioral_baseline
-        #     )
-        # else:
-        #     task2_results = {}
-
-        # behavioral_baseline = build_behavioral_baseline(behavioral_features)
-        # task2_results = detect_behavioral_anomalies(
-        #     behavioral_features,
-        #     behavioral_baseline
-        # )
+    stat_baseline = build_trial_baseline(stat_features)
+    return detect_statistical_anomalies(stat_features, stat_baseline)
 
-        behavioral_baseline = build_behavioral_baseline(behavioral_features)
 
+def _task2_behavioral(trial):
+    behavioral_features = map_hospitals(extract_behavioral_features, trial)
+
+    if DETECTOR_MODE == "matrix":
+        behavioral_matrix = stack_behavioral_features(behavioral_features)
+        task2_results = detect_behavioral_anomalies_matrix(
+            behavioral_matrix,
+            baseline=build_behavioral_baseline_matrix(behavioral_matrix),
+            trial_phase="PHASE_3"
+        )
+    else:
+        behavioral_baseline = build_behavioral_baseline(behavioral_features)
         task2_results = detect_behavioral_anomalies(
             behavioral_features,
             baseline=behavioral_baseline,
             trial_phase="PHASE_3"
         )
 
+    print("DEBUG TASK 2 RAW OUTPUT:")
+    for k, v in task2_results.items():
+        print(k, v)
 
+    return task2_results
 
-        print("DEBUG TASK 2 RAW OUTPUT:")
-        for k, v in task2_results.items():
-            print(k, v)
 
+def _cross_patient_hospitals(trial):
+    # In-memory only
+    cross_patient_features = extract_cross_patient_features(trial)
+
+    if cross_patient_features:
+        return detect_cross_patient_templating(cross_patient_features)
+    return {}
+
+
+def _task3_cross_patient(trial):
+    # Extraction and detection are both hospital-local
+    return map_hospitals(_cross_patient_hospitals, trial)
 
-        # -----------------------------
-        # Task 3: Cross-patient templating (in-memory only)
-        # -----------------------------
-        cross_patient_features = extract_cross_patient_features(df)
 
-        if cross_patient_features:
-            task3_results = detect_cross_patient_templating(cross_patient_features)
+_peer_index = None
+
+
+def _reference_peer_index():
+    # Loaded once per process; None builds the index per trial
+    global _peer_index
+    if _peer_index is None and PEER_INDEX_PATH:
+        _peer_index = PeerIndex.load(PEER_INDEX_PATH)
+    return _peer_index
+
+
+def _hospital_sizes(trial):
+    # Visit count per hospital, only when Task 4 uses size features
+    if not PEER_SIZE_FEATURES:
+        return None
+
+    counts = np.bincount(
+        trial.hospital_codes[trial.visits], minlength=len(trial.hospitals)
+    )
+    return {
+        hospital_id: int(count)
+        for hospital_id, count in zip(trial.hospitals, counts)
+        if count
+    }
+
+
+def _task4_cross_hospital(task1_results, task2_results, task3_results, hospital_sizes=None):
+    cross_hospital_features = extract_cross_hospital_features(
+        task1_results,
+        task2_results,
+        task3_results,
+        hospital_sizes=hospital_sizes
+    )
+
+    if CROSS_HOSPITAL_MODE == "peers":
+        return detect_peer_group_deviation(
+            cross_hospital_features, index=_reference_peer_index()
+        )
+    return detect_cross_hospital_deviation(cross_hospital_features)
+
+
+def cross_hospital_vectors(trial_id):
+    """
+    Task 4 input vectors of a trial's hospitals, computed as a run
+    computes them (used by build_peer_index.py).
+    """
+    df = load_trial_visits(trial_id)
+    if df.empty:
+        return {}
+
+    trial = TrialFrame(df)
+    return extract_cross_hospital_features(
+        _task1_statistical(trial),
+        _task2_behavioral(trial),
+        _task3_cross_patient(trial),
+        hospital_sizes=_hospital_sizes(trial)
+    )
+
+
+# Stage DAG: (name, compute, inputs); "trial" is the run's TrialFrame
+STAGES = (
+    Stage("task1", _task1_statistical, ("trial",)),
+    Stage("task2", _task2_behavioral, ("trial",)),
+    Stage("task3", _task3_cross_patient, ("trial",)),
+    Stage("sizes", _hospital_sizes, ("trial",)),
+    Stage("task4", _task4_cross_hospital, ("task1", "task2", "task3", "sizes")),
+)
+
+# Detector (ENABLED_DETECTORS entry) -> the stage producing its results
+DETECTOR_STAGES = {
+    "statistical": "task1",
+    "behavioral": "task2",
+    "cross_patient": "task3",
+    "cross_hospital": "task4"
+}
+
+
+# -----------------------------
+# Resume support
+# -----------------------------
+
+def _resumable_run(trial_id):
+    """
+    The trial's last finished run, if it failed and left checkpoints.
+    """
+    latest = fetch_latest_finished_run(trial_id)
+    if latest is None:
+        return None
+
+    ai_run_id, status = latest
+    if status != "failed" or read_fingerprint(ai_run_id) is None:
+        return None
+    return ai_run_id
+
+
+def _clear_stale_checkpoints(ai_run_id):
+    # The run can never resume (new visits or settings); leave a run
+    # someone else has just claimed alone
+    run = fetch_ai_run(ai_run_id)
+    if run is not None and run[1] == "failed":
+        clear_checkpoints(ai_run_id)
+
+
+def _resume_run(trial_id, fingerprint):
+    """
+    Claims the trial's failed run for a resumed retry if its stages
+    were computed on `fingerprint`; None otherwise.
+    """
+    ai_run_id = _resumable_run(trial_id)
+    if ai_run_id is None:
+        return None
+
+    if read_fingerprint(ai_run_id) != fingerprint:
+        _clear_stale_checkpoints(ai_run_id)
+        return None
+
+    # A cron run and a job can both find the run; only one claims it
+    if not reopen_ai_run(ai_run_id):
+        return None
+    return ai_run_id
+
+
+def _create_ai_run(trial_id, triggered_by):
+    return create_ai_run(
+        trial_id=trial_id,
+        ai_version="v1.0",
+        trigger_type="manual",
+        triggered_by=triggered_by,
+        notes="Task 1 + Task 2 analysis"
+    )
+
+
+def open_ai_run(trial_id, triggered_by=None):
+    """
+    Creates the ai_runs row for a run started ahead of its compute
+    (see jobs.py). A failed run is reopened instead, so
+    run_ai_for_trial can resume it, if no visits were locked since and
+    this call claims it first.
+    """
+    resume_run_id = _resumable_run(trial_id)
+    if resume_run_id is not None:
+        rows = count_locked_values(trial_id, datetime.now(timezone.utc))
+        if not checkpoints_cover(resume_run_id, rows):
+            _clear_stale_checkpoints(resume_run_id)
+        elif reopen_ai_run(resume_run_id):
+            return resume_run_id
+
+    return _create_ai_run(trial_id, triggered_by)
+
+
+def run_ai_for_trial(trial_id, triggered_by=None, df=None, writer=None,
+                     ai_run_id=None, progress=None):
+    """
+    Runs Tasks 1-4 for a trial and persists the results.
+
+    With a persistence.pipeline.WriteBehindQueue as writer, results are
+    handed to its writer thread and this returns as soon as compute is
+    done; the writer marks the run failed if the write fails.
+
+    If the trial's last run failed on the same data, that run is resumed
+    from its stage checkpoints instead of starting a new one. With
+    ai_run_id (from open_ai_run) the run is recorded under that id,
+    unless it is a reopened failed run and visits were locked since:
+    that run is failed again and a new one is created.
+
+    progress(step, done, total) is called after every finished step
+    ("fetch", each stage, "persist").
+
+    Returns the ai_run_id, or None if the trial has no locked visits.
+    An exception raised after the run was created carries it as
+    e.ai_run_id.
+    """
+    # 1. Fetch immutable data (delta on top of the local snapshot),
+    #    unless the caller already loaded it in a batch; a resumed run
+    #    reloads it the same way
+    try:
+        if df is None:
+            df = load_trial_visits(trial_id)
+    except Exception as e:
+        # A run opened ahead of the fetch must not stay "running"
+        if ai_run_id is not None:
+            finalize_ai_run(ai_run_id, status="failed")
+            e.ai_run_id = ai_run_id
+        raise
+
+    if df.empty:
+        print("No locked visits found.")
+        if ai_run_id is not None:
+            finalize_ai_run(ai_run_id, status="failed")
+        return
+
+    fingerprint = frame_fingerprint(df)
+
+    # 2. Create AI run (or resume the failed one). The failed run is
+    #    only claimed now that the data is known to match it.
+    if ai_run_id is not None and read_fingerprint(ai_run_id) not in (None, fingerprint):
+        # Reopened by open_ai_run, but the data has changed since: keep
+        # its failure on record rather than reuse it for other data
+        finalize_ai_run(ai_run_id, status="failed")
+        print(f"AI run {ai_run_id} no longer matches the trial data.")
+        ai_run_id = None
+
+    if ai_run_id is not None:
+        print(f"AI run started: {ai_run_id}")
+    else:
+        ai_run_id = _resume_run(trial_id, fingerprint)
+        if ai_run_id is not None:
+            print(f"AI run resumed: {ai_run_id}")
         else:
-            task3_results = {}
+            ai_run_id = _create_ai_run(trial_id, triggered_by)
+            print(f"AI run started: {ai_run_id}")
+
+    try:
+        start_checkpoints(ai_run_id, fingerprint)
 
+        # Codes, timestamps and group sorts shared by every extractor
+        trial = TrialFrame(df)
 
         # -----------------------------
-        # Task 4: Cross-hospital deviation
+        # Tasks 1-4: only the stages the enabled detectors need,
+        # independent ones concurrently (each one is checkpointed)
         # -----------------------------
-        cross_hospital_features = extract_cross_hospital_features(
-            task1_results,
-            task2_results,
-            task3_results
+        targets = [DETECTOR_STAGES[name] for name in ENABLED_DETECTORS]
+
+        # fetch + the stages + persist
+        steps = len(required_stages(STAGES, targets)) + 2
+        done = [0]
+        progress_lock = threading.Lock()
+
+        def report(step):
+            if progress is None:
+                return
+            with progress_lock:
+                done[0] += 1
+                progress(step, done[0], steps)
+
+        def execute(stage, *inputs):
+            output = run_stage(ai_run_id, stage.name, stage.compute, *inputs)
+            report(stage.name)
+            return output
+
+        report("fetch")
+        outputs = run_stages(STAGES, targets, {"trial": trial}, execute, STAGE_WORKERS)
+
+        # A stage computed only as another's input is not reported
+        task1_results, task2_results, task3_results, task4_results = (
+            outputs[name] if name in targets else {}
+            for name in ("task1", "task2", "task3", "task4")
         )
 
-        task4_results = detect_cross_hospital_deviation(cross_hospital_features)
-
-
         # -----------------------------
         # Merge + Persist
         # -----------------------------
@@ -123,8 +377,12 @@ def run_ai_for_trial(trial_id, triggered_by=None):
             set(task1_results.keys())
             | set(task2_results.keys())
             | set(task3_results.keys())
+            | set(task4_results.keys())
         )
 
+        run_scores = []
+        run_signals = []
+
         for hospital_id in all_hospital_ids:
             stat = task1_results.get(hospital_id, {})
             beh = task2_results.get(hospital_id, {})
@@ -173,15 +431,13 @@ def run_ai_for_trial(trial_id, triggered_by=None):
             else:
                 risk_level = "HIGH"
 
-            # Save hospital scores
-            save_hospital_scores(
-                ai_run_id=ai_run_id,
-                trial_id=trial_id,
-                hospital_id=hospital_id,
-                scores=scores,
-                risk_score=risk_score,
-                risk_level=risk_level
-            )
+            # Collect hospital scores
+            run_scores.append({
+                "hospital_id": hospital_id,
+                "scores": scores,
+                "risk_score": risk_score,
+                "risk_level": risk_level
+            })
 
             # Collect anomaly signals
             db_signals = []
@@ -223,11 +479,8 @@ def run_ai_for_trial(trial_id, triggered_by=None):
                 })
 
 
-            save_anomaly_signals(
-                ai_run_id=ai_run_id,
-                trial_id=trial_id,
-                hospital_id=hospital_id,
-                signals=db_signals
+            run_signals.extend(
+                {"hospital_id": hospital_id, **sig} for sig in db_signals
             )
 
             # Debug print
@@ -240,11 +493,29 @@ def run_ai_for_trial(trial_id, triggered_by=None):
             else:
                 print("Signals: None")
 
-        # 5. Finalize run
-        finalize_ai_run(ai_run_id, status="completed")
-        print("AI run completed successfully.")
+        # 5. Persist scores + signals and finalize run in one transaction
+        run_results = dict(
+            ai_run_id=ai_run_id,
+            trial_id=trial_id,
+            hospital_scores=run_scores,
+            signals=run_signals,
+            status="completed"
+        )
+
+        if writer is not None:
+            writer.submit(**run_results)
+            print("AI run computed, queued for persistence.")
+        else:
+            save_run_results(**run_results)
+            clear_checkpoints(ai_run_id)
+            print("AI run completed successfully.")
+        report("persist")
+
+        return ai_run_id
 
     except Exception as e:
         finalize_ai_run(ai_run_id, status="failed")
         print("AI run failed:", str(e))
+        # Lets callers report which ai_runs row failed
+        e.ai_run_id = ai_run_id
         raise
@@ -0,0 +1,66 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+# ---------------------------
+# Stage DAG
+# ---------------------------
+#
+# A stage is a named function of named inputs; an input is either
+# another stage's output or a value given to run_stages. Only the
+# stages needed for the targets run, each as soon as its inputs are
+# ready, so independent stages overlap.
+
+Stage = namedtuple("Stage", ["name", "compute", "inputs"])
+
+
+def required_stages(stages, targets):
+    """
+    The targets and every stage they depend on, in declaration order.
+    """
+    by_name = {stage.name: stage for stage in stages}
+
+    needed = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        # Names that are not stages are values given to run_stages
+        if name in needed or name not in by_name:
+            continue
+        needed.add(name)
+        stack.extend(by_name[name].inputs)
+
+    return [stage for stage in stages if stage.name in needed]
+
+
+def run_stages(stages, targets, values, execute, max_workers):
+    """
+    Runs the stages the targets need on a pool of max_workers threads.
+
+    values:  {input name: value} for inputs that are not stages
+    execute: execute(stage, *inputs) -> output (e.g. with checkpointing)
+
+    Returns values plus every computed stage output, by name. The first
+    failing stage's exception is raised once running stages finish.
+    """
+    pending = required_stages(stages, targets)
+    values = dict(values)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for stage in [s for s in pending if all(i in values for i in s.inputs)]:
+                pending.remove(stage)
+                inputs = [values[i] for i in stage.inputs]
+                running[pool.submit(execute, stage, *inputs)] = stage
+
+            if not running:
+                missing = sorted({i for s in pending for i in s.inputs} - set(values))
+                raise ValueError(f"Stage inputs never become available: {missing}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                values[stage.name] = future.result()
+
+    return values
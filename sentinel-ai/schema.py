@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+# ---------------------------
+# Compact trial frame schema
+# ---------------------------
+#
+#   visit_id, hospital_id,        category  (integer codes + id lookup table)
+#   patient_id, crf_field_id
+#   visit_date, created_at        int64     (ns since epoch, UTC)
+#   value_number                  float64
+#
+# Group-bys on the id columns run on the integer codes; pass
+# observed=True so only id combinations that occur are produced.
+
+ID_COLUMNS = ("trial_id", "visit_id", "hospital_id", "patient_id", "crf_field_id")
+TIMESTAMP_COLUMNS = ("visit_date", "created_at")
+
+NS_PER_HOUR = 3600 * 10**9
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+
+def compact_frame(df):
+    """
+    Converts a frame with string ids / datetime64 timestamps to the
+    compact schema (in place) and returns it.
+    """
+    for col in df.columns:
+        if col in ID_COLUMNS and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(str).astype("category")
+        elif col in TIMESTAMP_COLUMNS and df[col].dtype != np.int64:
+            df[col] = df[col].astype("datetime64[ns]").astype("int64")
+        elif col == "value_number":
+            df[col] = df[col].astype("float64")
+
+    return df
+
+
+def concat_frames(frames):
+    """
+    pd.concat for compact frames; id columns keep the category dtype
+    (plain concat falls back to object when the categories differ).
+    """
+    if len(frames) == 1:
+        return frames[0]
+
+    columns = {}
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            columns[col] = union_categoricals(
+                [f[col] for f in frames], ignore_order=True
+            )
+        else:
+            columns[col] = np.concatenate([f[col].to_numpy() for f in frames])
+
+    return pd.DataFrame(columns, columns=frames[0].columns)
+
+
+def to_datetime(values):
+    """int64 epoch-ns values -> datetime64[ns]"""
+    return pd.to_datetime(values, unit="ns")
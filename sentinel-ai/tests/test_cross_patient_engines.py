@@ -0,0 +1,113 @@
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+import detectors.cross_patient
+from detectors.cross_patient import (
+    ENGINES,
+    _grid_pair_matches,
+    _blocked_pair_matches,
+    pair_match_counts
+)
+
+
+def _baseline_matches(first, last, slope, value_tol, slope_tol):
+    """
+    The original combinations() loop: {(a, b): matching fields}.
+    """
+    matches = {}
+    for a, b in combinations(range(len(first)), 2):
+        matching_fields = 0
+        for f in range(first.shape[1]):
+            # Missing signatures are not common fields
+            if np.isnan(first[a, f]) or np.isnan(first[b, f]):
+                continue
+            if (
+                abs(first[a, f] - first[b, f]) <= value_tol and
+                abs(last[a, f] - last[b, f]) <= value_tol and
+                abs(slope[a, f] - slope[b, f]) <= slope_tol
+            ):
+                matching_fields += 1
+        if matching_fields:
+            matches[(a, b)] = matching_fields
+    return matches
+
+
+def _signatures(seed, n_patients, n_fields, decimals, scale):
+    rng = np.random.default_rng(seed)
+    first = np.round(rng.normal(50, scale, (n_patients, n_fields)), decimals)
+    last = np.round(first + rng.normal(0, scale / 3, (n_patients, n_fields)), decimals)
+
+    # A few copied patients, so some pairs are templated
+    copies = rng.integers(0, n_patients, (n_patients // 10, 2))
+    first[copies[:, 1]] = first[copies[:, 0]]
+    last[copies[:, 1]] = last[copies[:, 0]]
+
+    missing = rng.random((n_patients, n_fields)) < 0.2
+    first[missing] = np.nan
+    last[missing] = np.nan
+    return first, last, last - first
+
+
+CASES = [
+    # (seed, patients, fields, decimals, scale)
+    (0, 60, 6, 2, 1.0),     # sparse cells
+    (1, 80, 8, 1, 0.5),
+    (2, 120, 10, 0, 2.0),   # integer values: most patients share cells
+    (3, 40, 5, 0, 0.3)
+]
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("tols", [(0.1, 0.1), (0.5, 0.2), (0.0, 0.1)])
+@pytest.mark.parametrize("min_matching_fields", [1, 2, 4])
+def test_engines_match_baseline(case, tols, min_matching_fields, monkeypatch):
+    # Small hospitals are "crowded" by share; keep the grid engine on
+    monkeypatch.setattr(detectors.cross_patient, "GRID_MAX_CANDIDATE_SHARE", 1.0)
+    first, last, slope = _signatures(*case)
+    baseline = _baseline_matches(first, last, slope, *tols)
+    expected = sum(1 for n in baseline.values() if n >= min_matching_fields)
+
+    for name, count_templated_pairs in ENGINES.items():
+        assert count_templated_pairs(
+            first, last, slope, *tols, min_matching_fields
+        ) == expected, name
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_pair_matches_match_baseline(case, monkeypatch):
+    monkeypatch.setattr(detectors.cross_patient, "GRID_MAX_CANDIDATE_SHARE", 1.0)
+    first, last, slope = _signatures(*case)
+    baseline = _baseline_matches(first, last, slope, 0.1, 0.1)
+
+    # A tiny chunk exercises the chunked checks and merges of the grid
+    results = [
+        _grid_pair_matches(first, last, slope, 0.1, 0.1, chunk=7),
+        _blocked_pair_matches(first, last, slope, 0.1, 0.1, block_mb=0.01)
+    ]
+    for a, b, counts in results:
+        assert dict(zip(zip(a.tolist(), b.tolist()), counts.tolist())) == baseline
+
+
+def test_crowded_grid_falls_back():
+    # Every patient in the same cells: the grid hands off to blocked
+    first = np.zeros((200, 20))
+    assert _grid_pair_matches(first, first, first, 0.1, 0.1) is None
+    assert ENGINES["grid"](first, first, first, 0.1, 0.1, 4) == 200 * 199 // 2
+
+
+def test_pair_match_counts_engines_agree():
+    first, last, slope = _signatures(4, 50, 6, 1, 0.5)
+    signatures = {
+        "patient_ids": np.array([f"p{i}" for i in range(50)]),
+        "first": first,
+        "last": last,
+        "slope": slope
+    }
+
+    results = [
+        pair_match_counts(signatures, engine=engine) for engine in ENGINES
+    ]
+    as_sets = [set(zip(a.tolist(), b.tolist(), c.tolist())) for a, b, c in results]
+    assert all(s == as_sets[0] for s in as_sets)
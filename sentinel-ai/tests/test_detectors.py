@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from detectors.statistical import (
+    build_trial_baseline,
+    detect_statistical_anomalies,
+    stack_statistical_features,
+    build_trial_baseline_matrix,
+    detect_statistical_anomalies_matrix
+)
+from detectors.behavioral import (
+    build_behavioral_baseline,
+    detect_behavioral_anomalies,
+    stack_behavioral_features,
+    build_behavioral_baseline_matrix,
+    detect_behavioral_anomalies_matrix
+)
+
+
+# The dict detectors are the original per-hospital loops; the matrix
+# detectors must give the same results, in the same order.
+
+def _statistical_features(seed, n_hospitals, n_fields):
+    """
+    hospital -> field -> features, with fields missing per hospital,
+    a few outlying means and ties in every feature.
+    """
+    rng = np.random.default_rng(seed)
+    features = {}
+    for h in range(n_hospitals):
+        hospital_data = {}
+        for f in range(n_fields):
+            if rng.random() < 0.2:
+                continue
+            hospital_data[f"f{f}"] = {
+                "mean": float(np.round(rng.normal(50, 5), 1)) * (3 if rng.random() < 0.05 else 1),
+                "std": float(np.round(abs(rng.normal(5, 1)), 1)),
+                "iqr": 1.0,
+                "entropy": float(np.round(abs(rng.normal(2, 0.2)), 2)),
+                "rounding_ratio": float(rng.choice([0.0, 0.2, 0.5, 1.0])),
+                "count": 10
+            }
+        if hospital_data:
+            features[f"h{h}"] = hospital_data
+    return features
+
+
+def _behavioral_features(seed, n_hospitals):
+    rng = np.random.default_rng(seed)
+    features = {}
+    for h in range(n_hospitals):
+        features[f"h{h}"] = {
+            "min_visit_gap_days": 3.0,
+            "short_gap_ratio": float(rng.choice([0.0, 0.0, 0.25, 1 / 3, 0.67])),
+            "hard_gap_violations": int(rng.random() < 0.1),
+            "median_delay_days": float(abs(rng.normal(3, 1))) * (4 if rng.random() < 0.1 else 1),
+            "p90_delay_days": float(abs(rng.normal(8, 2))),
+            "submission_burstiness": float(abs(rng.normal(20, 5))) * (5 if rng.random() < 0.1 else 1),
+            "same_hour_ratio": float(rng.random()),
+            "weekend_ratio": float(rng.random() ** 3),
+            "same_day_visit_ratio": float(rng.random() ** 2),
+            "visit_count": 10
+        }
+    return features
+
+
+STATISTICAL_CASES = [
+    # (seed, hospitals, fields)
+    (0, 12, 8),
+    (1, 30, 3),
+    (2, 2, 10),
+    (3, 1, 5)       # a single hospital: every sigma is the 1e-6 guard
+]
+
+
+@pytest.mark.parametrize("case", STATISTICAL_CASES)
+def test_statistical_matrix_matches_dict(case):
+    features = _statistical_features(*case)
+    expected = detect_statistical_anomalies(features, build_trial_baseline(features))
+
+    matrix = stack_statistical_features(features)
+    results = detect_statistical_anomalies_matrix(
+        matrix, build_trial_baseline_matrix(matrix), features
+    )
+    assert list(results) == list(expected)
+    assert results == expected
+
+
+def test_statistical_matrix_field_in_one_hospital():
+    features = _statistical_features(4, 6, 4)
+    features["h0"]["only_here"] = dict(features["h0"]["f0"], mean=1000.0)
+
+    matrix = stack_statistical_features(features)
+    assert detect_statistical_anomalies_matrix(
+        matrix, build_trial_baseline_matrix(matrix), features
+    ) == detect_statistical_anomalies(features, build_trial_baseline(features))
+
+
+@pytest.mark.parametrize("seed,n_hospitals", [(0, 25), (1, 3), (2, 1), (3, 0)])
+@pytest.mark.parametrize("trial_phase", ["PHASE_2", "PHASE_3", "UNKNOWN"])
+@pytest.mark.parametrize("with_baseline", [True, False])
+def test_behavioral_matrix_matches_dict(seed, n_hospitals, trial_phase, with_baseline):
+    features = _behavioral_features(seed, n_hospitals)
+    use_baseline = with_baseline and bool(features)
+
+    expected = detect_behavioral_anomalies(
+        features,
+        baseline=build_behavioral_baseline(features) if use_baseline else None,
+        trial_phase=trial_phase
+    )
+
+    matrix = stack_behavioral_features(features)
+    results = detect_behavioral_anomalies_matrix(
+        matrix,
+        baseline=build_behavioral_baseline_matrix(matrix) if use_baseline else None,
+        trial_phase=trial_phase
+    )
+    assert list(results) == list(expected)
+    assert results == expected
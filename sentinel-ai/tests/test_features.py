@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import iqr, entropy
+
+from schema import compact_frame
+from features.statistical import extract_statistical_features
+from features.behavioral import extract_behavioral_features
+from features.cross_patient import extract_cross_patient_features
+
+
+# ---------------------------
+# Original per-group extractors
+# ---------------------------
+
+def _baseline_statistical(df):
+    """
+    The original groupby loop of extract_statistical_features.
+    """
+    features = {}
+    for (hospital_id, field_id), g in df.groupby(["hospital_id", "crf_field_id"]):
+        values = g["value_number"].dropna().values
+        if len(values) < 5:
+            continue
+
+        hist, _ = np.histogram(values, bins=10, density=True)
+        hist = hist[hist > 0]
+
+        features.setdefault(hospital_id, {})[field_id] = {
+            "mean": float(np.mean(values)),
+            "std": float(np.std(values)),
+            "iqr": float(iqr(values)),
+            "entropy": float(entropy(hist)),
+            "rounding_ratio": len([v for v in values if v % 5 == 0]) / len(values),
+            "count": int(len(values))
+        }
+    return features
+
+
+def _baseline_behavioral(df):
+    """
+    The original per-hospital / per-patient loop of
+    extract_behavioral_features.
+    """
+    features = {}
+    for hospital_id, hdf in df.groupby("hospital_id"):
+        hdf_visits = hdf.drop_duplicates(subset=["visit_id"]).copy()
+        if len(hdf_visits) < 2:
+            continue
+
+        visit_dates = pd.to_datetime(hdf_visits["visit_date"])
+        created_times = pd.to_datetime(hdf_visits["created_at"])
+        hdf_visits["visit_date"] = visit_dates
+
+        gap_violations = 0
+        hard_violations = 0
+        total_pairs = 0
+        min_gap_days = None
+        for _, pdf in hdf_visits.groupby("patient_id"):
+            if len(pdf) < 2:
+                continue
+            gaps = pdf.sort_values("visit_date")["visit_date"].diff()
+            gaps = (gaps.dt.total_seconds() / (24 * 3600)).dropna()
+
+            total_pairs += len(gaps)
+            min_gap = gaps.min()
+            min_gap_days = min(min_gap_days, min_gap) if min_gap_days is not None else min_gap
+            hard_violations += (gaps < 1).sum()
+            gap_violations += (gaps < 7.0).sum()
+
+        delays = (created_times - visit_dates).dt.total_seconds() / (24 * 3600)
+        delays = delays[delays >= 0]
+
+        inter_arrival_hours = (
+            created_times.sort_values().diff().dt.total_seconds() / 3600
+        ).dropna()
+
+        features[hospital_id] = {
+            "min_visit_gap_days": float(min_gap_days) if min_gap_days is not None else None,
+            "short_gap_ratio": float(gap_violations / total_pairs if total_pairs > 0 else 0.0),
+            "hard_gap_violations": int(hard_violations),
+            "median_delay_days": float(np.median(delays)) if len(delays) else 0.0,
+            "p90_delay_days": float(np.percentile(delays, 90)) if len(delays) else 0.0,
+            "submission_burstiness": float(np.std(inter_arrival_hours)) if len(inter_arrival_hours) else 0.0,
+            "same_hour_ratio": float(created_times.dt.hour.value_counts(normalize=True).iloc[0]),
+            "weekend_ratio": float((created_times.dt.weekday >= 5).mean()),
+            "same_day_visit_ratio": float(visit_dates.dt.date.value_counts(normalize=True).iloc[0]),
+            "visit_count": int(len(hdf_visits))
+        }
+    return features
+
+
+def _baseline_cross_patient(df):
+    """
+    The original per-(hospital, patient, field) loop of
+    extract_cross_patient_features: hospital -> patient -> field -> signature.
+    """
+    df = df[df["value_number"].notna()]
+    features = {}
+    for hospital_id, hdf in df.groupby("hospital_id"):
+        for patient_id, pdf in hdf.groupby("patient_id"):
+            signatures = {}
+            for field_id, fdf in pdf.groupby("crf_field_id"):
+                values = fdf.sort_values("visit_date")["value_number"].astype(float).values
+                if len(values) < 2:
+                    continue
+                signatures[field_id] = {
+                    "first": float(values[0]),
+                    "last": float(values[-1]),
+                    "slope": float(values[-1] - values[0]),
+                    "std": float(np.std(values))
+                }
+            if signatures:
+                features.setdefault(hospital_id, {})[patient_id] = signatures
+    return features
+
+
+# ---------------------------
+# Synthetic trials
+# ---------------------------
+
+FIELDS = ["f0", "f1", "f2", "f3"]
+
+
+def _trial(seed, n_hospitals=5, n_patients=8):
+    """
+    Seeded trial with rounded values (ties, multiples of 5), missing
+    values, same-day repeat visits, patients with one visit, data
+    entered before the visit, plus hand-made edge hospitals.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2024-01-01")
+    rows = []
+
+    def add_visit(visit_id, hospital_id, patient_id, visit_date, created_at, values):
+        for field_id, value in zip(FIELDS, values):
+            if value is not None:
+                rows.append((visit_id, hospital_id, patient_id, visit_date,
+                             created_at, field_id, value))
+
+    for h in range(n_hospitals):
+        hospital_id = f"h{h}"
+        decimals = int(rng.integers(-1, 2))
+        for p in range(n_patients):
+            patient_id = f"{hospital_id}-p{p}"
+            visit_date = start + pd.Timedelta(days=int(rng.integers(0, 30)))
+            values = None
+            for v in range(int(rng.integers(1, 6))):
+                gap = int(rng.choice([0, 1, 3, 7, 14])) if v else None
+                if gap:
+                    visit_date += pd.Timedelta(days=gap, hours=int(rng.integers(0, 5)))
+                # A same-time repeat (gap 0) copies the previous visit's
+                # values, so the order of tied visits never matters
+                if gap != 0:
+                    values = [
+                        None if rng.random() < 0.1 else
+                        np.nan if rng.random() < 0.05 else
+                        float(np.round(rng.normal(100 + 10 * f, 8), decimals))
+                        for f in range(len(FIELDS))
+                    ]
+                created_at = visit_date + pd.Timedelta(
+                    minutes=int(rng.integers(-600, 7 * 24 * 60))
+                )
+                add_visit(f"{patient_id}-v{v}", hospital_id, patient_id,
+                          visit_date, created_at, values)
+
+    # Flat fields (np.histogram widens their range), a field with
+    # exactly MIN_GROUP_VALUES values and one with a single value
+    for v in range(6):
+        visit_date = start + pd.Timedelta(days=7 * v)
+        add_visit(f"flat-v{v}", "flat", f"flat-p{v % 2}", visit_date,
+                  visit_date + pd.Timedelta(hours=v),
+                  [42.0, 5.0 * (v % 2), float(v) if v < 5 else None,
+                   1.5 if v == 0 else None])
+
+    # Hospitals with one visit and with two visits of different patients
+    add_visit("solo-v0", "solo", "solo-p0", start, start + pd.Timedelta(hours=1),
+              [1.0, 2.0, 3.0, 4.0])
+    for v in range(2):
+        add_visit(f"pair-v{v}", "pair", f"pair-p{v}", start, start - pd.Timedelta(hours=v),
+                  [1.0, 2.0, 3.0, 4.0])
+
+    return pd.DataFrame(rows, columns=[
+        "visit_id", "hospital_id", "patient_id", "visit_date",
+        "created_at", "crf_field_id", "value_number"
+    ])
+
+
+def _assert_close(actual, expected, path=()):
+    if isinstance(expected, dict):
+        assert actual.keys() == expected.keys(), path
+        for key in expected:
+            _assert_close(actual[key], expected[key], path + (key,))
+    elif expected is None:
+        assert actual is None, path
+    else:
+        assert actual == pytest.approx(expected, rel=1e-9, abs=1e-12), path
+
+
+SEEDS = [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_statistical_features_match_baseline(seed):
+    df = _trial(seed)
+    features = extract_statistical_features(compact_frame(df.copy()))
+
+    _assert_close(features, _baseline_statistical(df))
+    assert set(features["flat"]) == {"f0", "f1", "f2"}
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_behavioral_features_match_baseline(seed):
+    df = _trial(seed)
+    features = extract_behavioral_features(compact_frame(df.copy()))
+
+    _assert_close(features, _baseline_behavioral(df))
+    assert "solo" not in features
+    assert features["pair"]["min_visit_gap_days"] is None
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_cross_patient_features_match_baseline(seed):
+    df = _trial(seed)
+    features = extract_cross_patient_features(compact_frame(df.copy()))
+
+    # Matrices back to hospital -> patient -> field -> signature
+    nested = {}
+    for hospital_id, s in features.items():
+        for i, j in zip(*np.nonzero(~np.isnan(s["first"]))):
+            nested.setdefault(hospital_id, {}).setdefault(s["patient_ids"][i], {})[
+                s["field_ids"][j]
+            ] = {k: float(s[k][i, j]) for k in ("first", "last", "slope", "std")}
+
+    _assert_close(nested, _baseline_cross_patient(df))